@@ -8,9 +8,8 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from elasticsearch import Elasticsearch
 from config import Config
-from redis import Redis
+from app.metrics import InstrumentedElasticsearch, InstrumentedRedis
 import rq
 from sqlalchemy import MetaData
 
@@ -36,7 +35,11 @@ metadata = MetaData(
     }
 )
 
-db=SQLAlchemy(metadata=metadata)
+from app import db_routing
+db=SQLAlchemy(metadata=metadata,
+              session_options={'class_': db_routing.RoutingSession})
+db.event.listen(db.session, 'after_commit', db_routing.after_commit)
+db.event.listen(db.session, 'after_rollback', db_routing.after_rollback)
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
@@ -49,16 +52,27 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    from app.db_pool import engine_options
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app)
     db.init_app(app)
+    app.db_replicas = db_routing.ReplicaSet(app)
     migrate.init_app(app, db, render_as_batch=True, compare_type=True)
     login.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
+    app.elasticsearch = InstrumentedElasticsearch(
+        [app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
+    from app.search import create_search_backend
+    app.search_backend = create_search_backend(app)
+    from app.translate import create_translator
+    app.translator = create_translator(app)
+    app.redis = InstrumentedRedis.from_url(app.config['REDIS_URL'])
     app.task_queue = rq.Queue('ai_companion-tasks', connection=app.redis)
+    app.mail_queue = rq.Queue('ai_companion-mail', connection=app.redis)
+    from app.email import MailPool
+    app.mail_pool = MailPool(app)
 
 
     from app.errors import bp as errors_bp
@@ -76,6 +90,9 @@ def create_app(config_class=Config):
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    from app.metrics import bp as metrics_bp
+    app.register_blueprint(metrics_bp)
+
     #change to this when application becomes real
     #if not app.debug and not app.testing:
     if app.debug and not app.testing:
@@ -0,0 +1,31 @@
+import os
+from flask import current_app
+from app.api import bp
+from app.api.auth import token_auth
+from app.cache import Cache
+from app.email import mail_stats
+from app.db_pool import pool_stats
+
+
+# counters are per process, so each gunicorn worker reports its own pid
+@bp.route('/cache_stats', methods=['GET'])
+@token_auth.login_required
+def get_cache_stats():
+    return {
+        'pid': os.getpid(),
+        'caches': {cache.prefix.rstrip(':'): cache.stats()
+                   for cache in Cache.instances}
+    }
+
+
+@bp.route('/mail_stats', methods=['GET'])
+@token_auth.login_required
+def get_mail_stats():
+    return dict(mail_stats(), pid=os.getpid())
+
+
+@bp.route('/pool_stats', methods=['GET'])
+@token_auth.login_required
+def get_pool_stats():
+    return dict(pool_stats.stats(), pid=os.getpid(),
+                replicas=current_app.db_replicas.stats())
@@ -2,25 +2,44 @@
 import sqlalchemy as sa
 from flask import request, url_for, abort
 from app import db
-from app.models import User
+from app.models import User, Companion
 from app.api import bp
 from app.api.auth import token_auth
 from app.api.errors import bad_request
+from app.db_routing import read_replica
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
+@read_replica
 def get_user(id):
     return db.get_or_404(User, id).to_dict()
 
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
+@read_replica
 def get_users():
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    if 'page' in request.args:
+        page = request.args.get('page', 1, type=int)
+        return User.to_collection_dict(sa.select(User).order_by(User.id),
+                                       page, per_page, 'api.get_users')
+    return User.to_cursor_collection_dict(
+        sa.select(User), [User.id], request.args.get('cursor'), per_page,
+        'api.get_users')
+
+
+@bp.route('/users/<int:id>/companions', methods=['GET'])
+@token_auth.login_required
+@read_replica
+def get_companions(id):
+    user = db.get_or_404(User, id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(sa.select(User), page, per_page,
-                                   'api.get_users')
+    return Companion.to_collection_dict(
+        user.companions.select().order_by(Companion.id), page, per_page,
+        'api.get_companions', id=id)
 
 
 @bp.route('/users', methods=['POST'])
@@ -0,0 +1,141 @@
+import colorsys
+import hashlib
+import os
+import re
+import struct
+import tempfile
+import zlib
+from flask import current_app, url_for
+import redis
+import sqlalchemy as sa
+
+# bump when the drawing changes, so cached images and ETags are replaced
+IDENTICON_VERSION = 1
+DIGEST_RE = re.compile(r'^[0-9a-f]{32}$')
+BACKGROUND = (240, 240, 240)
+
+
+def avatar_digest(email):
+    """The Gravatar hash of email, which also seeds the local identicon."""
+    return hashlib.md5(email.strip().lower().encode('utf-8')).hexdigest()
+
+
+def avatar_url(digest, size):
+    if current_app.config['AVATAR_PROVIDER'] == 'local':
+        return url_for('main.avatar', digest=digest, size=size)
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
+
+def _png(width, rows, palette):
+    # 8 bit paletted PNG, one filter byte (none) in front of every row
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data))
+    raw = b''.join(b'\x00' + row for row in rows)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, len(rows), 8, 3, 0, 0,
+                                   0)),
+        chunk(b'PLTE', b''.join(bytes(color) for color in palette)),
+        chunk(b'IDAT', zlib.compress(raw, 9)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def render_identicon(digest, size):
+    """A size x size PNG of the 5x5 mirrored pattern Gravatar also draws
+    for d=identicon: the low 15 bits of digest fill the left three columns,
+    the top bits pick the hue, and half a cell of margin goes around it."""
+    value = int(digest, 16)
+    hue = (value >> 116) / 4096
+    color = tuple(round(c * 255) for c in colorsys.hls_to_rgb(hue, 0.5, 0.55))
+    # 12 half cells across: a margin, five cells of two, a margin
+    cells = [(u - 1) // 2 if 1 <= u <= 10 else None
+             for u in (i * 12 // size for i in range(size))]
+    lines = {}
+    rows = []
+    for row in cells:
+        if row not in lines:
+            lines[row] = bytes(
+                1 if row is not None and col is not None and
+                value >> (row * 3 + min(col, 4 - col)) & 1 else 0
+                for col in cells)
+        rows.append(lines[row])
+    return _png(size, rows, [BACKGROUND, color])
+
+
+def _cache_path(digest, size):
+    return os.path.join(current_app.config['AVATAR_CACHE_DIR'], digest[:2],
+                        f'{digest}-{size}-v{IDENTICON_VERSION}.png')
+
+
+def _load_disk(digest, size):
+    try:
+        with open(_cache_path(digest, size), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _store_disk(digest, size, image):
+    path = _cache_path(digest, size)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written under a name of its own and renamed, so concurrent requests,
+    # threads of one process included, never read or publish half an image
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(image)
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+
+def _redis_key(digest, size):
+    return f'avatar:{digest}:{size}:v{IDENTICON_VERSION}'
+
+
+def _load_redis(digest, size):
+    try:
+        return current_app.redis.get(_redis_key(digest, size))
+    except redis.exceptions.RedisError:
+        return None
+
+
+def _store_redis(digest, size, image):
+    try:
+        current_app.redis.set(_redis_key(digest, size), image,
+                              ex=current_app.config['AVATAR_CACHE_TTL'])
+    except redis.exceptions.RedisError:
+        pass
+
+
+def _known(digest):
+    from app import db
+    from app.models import User
+    return db.session.scalar(sa.select(User.id).where(
+        User.avatar_digest == digest).limit(1)) is not None
+
+
+def identicon(digest, size):
+    """The identicon PNG, from AVATAR_CACHE_DIR when it is set and from
+    Redis otherwise. A miss is rendered, and stored only when the digest
+    belongs to a user, so requests for made-up digests cannot fill the
+    cache; rendering is cheap and browsers keep the image anyway."""
+    if current_app.config['AVATAR_CACHE_DIR']:
+        load, store = _load_disk, _store_disk
+    else:
+        load, store = _load_redis, _store_redis
+    image = load(digest, size)
+    if image is None:
+        image = render_identicon(digest, size)
+        if _known(digest):
+            store(digest, size, image)
+    return image
+
+
+def identicon_etag(digest, size):
+    # the image depends on nothing else, so no need to hash its bytes
+    return f'{digest}-{size}-v{IDENTICON_VERSION}'
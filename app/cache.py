@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from datetime import datetime
+import json
+import threading
+import time
+import redis
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app
+
+
+class LRUCache:
+    """Thread-safe in-process LRU with a per-entry time to live."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class Cache:
+    """JSON values stored in Redis under prefix, falling back to an
+    in-process LRU while Redis is unreachable. Hits and misses are counted
+    per process."""
+
+    instances = []
+
+    def __init__(self, prefix, maxsize=1024):
+        self.prefix = prefix
+        self.local = LRUCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+        Cache.instances.append(self)
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def get(self, key):
+        try:
+            raw = current_app.redis.get(self.prefix + key)
+            value = json.loads(raw) if raw is not None else None
+        except redis.exceptions.RedisError:
+            value = self.local.get(key)
+        self.record(value is not None)
+        return value
+
+    def get_many(self, *keys):
+        """Fetch several keys in one round trip, without counting them as
+        hits or misses."""
+        try:
+            raws = current_app.redis.mget([self.prefix + key for key in keys])
+            return [json.loads(raw) if raw is not None else None
+                    for raw in raws]
+        except redis.exceptions.RedisError:
+            return [self.local.get(key) for key in keys]
+
+    def set(self, key, value, ttl):
+        ttl = max(int(ttl), 1)
+        try:
+            current_app.redis.set(self.prefix + key, json.dumps(value), ex=ttl)
+        except redis.exceptions.RedisError:
+            self.local.set(key, value, ttl)
+
+    def set_many(self, values, ttl):
+        """Store a dict of values in one round trip."""
+        ttl = max(int(ttl), 1)
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            for key, value in values.items():
+                pipe.set(self.prefix + key, json.dumps(value), ex=ttl)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            for key, value in values.items():
+                self.local.set(key, value, ttl)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.local.delete(key)
+        try:
+            current_app.redis.delete(*[self.prefix + key for key in keys])
+        except redis.exceptions.RedisError:
+            pass
+
+    def incr(self, *keys):
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.incr(self.prefix + key)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            for key in keys:
+                self.local.set(key, (self.local.get(key) or 0) + 1,
+                               ttl=86400)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+def snapshot(obj, exclude=()):
+    """Return the loaded column values of obj as a JSON-friendly dict."""
+    data = {}
+    for attr in sa.inspect(obj).mapper.column_attrs:
+        if attr.key in exclude:
+            continue
+        value = getattr(obj, attr.key)
+        data[attr.key] = value.isoformat() if isinstance(value, datetime) \
+            else value
+    return data
+
+
+def restore(cls, data):
+    """Rebuild an instance of cls from a snapshot and attach it to the
+    session without a SELECT. Columns left out of the snapshot are loaded
+    lazily on first access. An instance already in the session wins."""
+    from app import db
+    mapper = sa.inspect(cls)
+    existing = db.session.identity_map.get(mapper.identity_key_from_primary_key(
+        [data[column.key] for column in mapper.primary_key]))
+    if existing is not None:
+        return existing
+    values = {}
+    for key, value in data.items():
+        if value is not None and isinstance(
+                mapper.column_attrs[key].columns[0].type, sa.DateTime):
+            value = datetime.fromisoformat(value)
+        values[key] = value
+    obj = cls(**values)
+    so.make_transient_to_detached(obj)
+    return db.session.merge(obj, load=False)
@@ -1,6 +1,16 @@
 import os
-from flask import Blueprint
+import time
+from flask import Blueprint, current_app
 import click
+import redis
+from rq import Worker
+from rq.job import Job
+from app.presence import flush_last_seen
+from app.email import send_email, mail_stats
+from app.language import detect_all, load_detector
+from app.models import reconcile_counters, Notification, SearchableMixin, \
+    SearchOutbox
+from app.seed import DISTRIBUTIONS, Seeder
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -37,3 +47,269 @@ def compile():
     """Compile all languages."""
     if os.system('pybabel compile -d app/translations'):
         raise RuntimeError('compile command failed')
+
+
+@bp.cli.group()
+def presence():
+    """User presence (last seen) commands."""
+    pass
+
+@presence.command()
+def flush():
+    """Write buffered last seen times to the database."""
+    count = flush_last_seen()
+    click.echo(f'Flushed last seen for {count} users.')
+
+
+
+@bp.cli.group()
+def notifications():
+    """Notification retention commands."""
+    pass
+
+@notifications.command()
+@click.option('--days', type=float,
+              help='Retention window, NOTIFICATION_RETENTION_DAYS by default.')
+@click.option('--chunk-size', type=int,
+              help='Rows per transaction, NOTIFICATION_PRUNE_CHUNK by default.')
+def prune(days, chunk_size):
+    """Delete notifications not updated within the retention window."""
+    def report(rows, seconds):
+        click.echo(f'Deleted {rows} rows in {seconds:.3f}s')
+
+    days = days or current_app.config['NOTIFICATION_RETENTION_DAYS']
+    deleted = Notification.prune(
+        time.time() - days * 86400,
+        chunk_size=chunk_size or current_app.config['NOTIFICATION_PRUNE_CHUNK'],
+        pause=current_app.config['NOTIFICATION_PRUNE_PAUSE'], report=report)
+    click.echo(f'Pruned {deleted} notifications older than {days:g} days.')
+
+@notifications.command()
+def schedule():
+    """Queue the prune job, which then reschedules itself."""
+    queue = current_app.task_queue
+    try:
+        # a running job reschedules itself when it is done
+        ids = queue.scheduled_job_registry.get_job_ids() + \
+            queue.started_job_registry.get_job_ids() + queue.get_job_ids()
+        if any(job is not None and
+               job.func_name == 'app.tasks.prune_notifications'
+               for job in Job.fetch_many(ids, connection=queue.connection)):
+            click.echo('The prune job is already scheduled or running.')
+            return
+        queue.enqueue('app.tasks.prune_notifications')
+    except redis.exceptions.RedisError:
+        raise click.ClickException('Could not reach Redis.')
+    click.echo('Queued the prune job.')
+
+
+
+@bp.cli.command()
+@click.option('--burst', is_flag=True, help='Exit once the queues are empty.')
+def worker(burst):
+    """Run an RQ worker, with its scheduler, for the task and mail queues.
+
+    The language profiles are loaded up front, so the jobs it forks share
+    them."""
+    load_detector()
+    Worker([current_app.task_queue, current_app.mail_queue],
+           connection=current_app.redis).work(with_scheduler=True, burst=burst)
+
+
+
+@bp.cli.group()
+def languages():
+    """Message language detection commands."""
+    pass
+
+@languages.command()
+@click.option('--batch-size', type=int,
+              help='Messages per UPDATE, LANGDETECT_BATCH_SIZE by default.')
+@click.option('--workers', default=1, help='Detection processes.')
+def backfill(batch_size, workers):
+    """Detect the language of every message that has none."""
+    def report(messages, rate):
+        click.echo(f'{messages} messages, {rate:.0f} msgs/s')
+
+    detect_all(batch_size or current_app.config['LANGDETECT_BATCH_SIZE'],
+               workers=workers, report=report)
+
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter commands."""
+    pass
+
+@counters.command()
+@click.option('--batch-size', default=1000, help='Users per transaction.')
+def reconcile(batch_size):
+    """Recompute companion and unread message counters."""
+    repaired = reconcile_counters(batch_size)
+    click.echo(f'Repaired counters for {repaired} users.')
+
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+@search.command()
+def status():
+    """Show pending search outbox entries and indexing lag."""
+    pending, lag = SearchOutbox.lag()
+    click.echo(f'{pending} entries pending, oldest is {lag:.1f}s old.')
+    parked = SearchOutbox.parked_count()
+    if parked:
+        click.echo(f'{parked} entries parked after repeated failures.')
+
+@search.command()
+def unpark():
+    """Retry the search outbox entries parked after repeated failures."""
+    count = SearchOutbox.unpark()
+    click.echo(f'Unparked {count} entries.')
+
+@search.command()
+def drain():
+    """Ship every due search outbox entry now."""
+    batch_size = current_app.config['SEARCH_OUTBOX_BATCH_SIZE']
+    total = 0
+    while True:
+        count = SearchOutbox.drain(batch_size)
+        total += count
+        if count < batch_size:
+            break
+    click.echo(f'Processed {total} entries.')
+
+@search.command()
+@click.argument('model')
+@click.option('--batch-size', default=500, help='Documents per bulk request.')
+@click.option('--workers', default=4, help='Concurrent bulk requests.')
+@click.option('--resume', is_flag=True,
+              help='Continue from the last checkpoint.')
+@click.option('--swap', is_flag=True,
+              help='Build a new index, then move the alias to it.')
+def reindex(model, batch_size, workers, resume, swap):
+    """Rebuild the search index for a searchable MODEL."""
+    def report(docs, rate):
+        click.echo(f'{docs} documents, {rate:.0f} docs/s')
+
+    if not current_app.search_backend:
+        raise click.ClickException('No search backend is configured.')
+    if swap and not current_app.elasticsearch:
+        raise click.ClickException('--swap needs Elasticsearch.')
+    try:
+        cls = SearchableMixin.model_for(model.lower())
+    except LookupError:
+        raise click.BadParameter(f'{model} is not searchable.')
+    cls.reindex(batch_size=batch_size, workers=workers, resume=resume,
+                swap=swap, report=report)
+
+
+
+@bp.cli.command()
+@click.argument('users', default=1000)
+@click.option('--messages', default=20.0,
+              help='Mean messages received per user.')
+@click.option('--message-distribution', default='exponential',
+              type=click.Choice(DISTRIBUTIONS))
+@click.option('--companions', default=2.0,
+              help='Mean companions per user.')
+@click.option('--companion-distribution', default='uniform',
+              type=click.Choice(DISTRIBUTIONS))
+@click.option('--chunk-size', default=5000, help='Rows per INSERT batch.')
+@click.option('--password', default='password',
+              help='Password shared by every seeded user.')
+@click.option('--days', default=365,
+              help='Spread timestamps over this many past days.')
+@click.option('--prefix', default='seed', help='Username prefix.')
+@click.option('--seed', 'random_seed', type=int,
+              help='Random seed, for repeatable data.')
+@click.option('--index/--no-index', default=True,
+              help='Add the new messages to the search index.')
+def seed(users, messages, message_distribution, companions,
+         companion_distribution, chunk_size, password, days, prefix,
+         random_seed, index):
+    """Bulk insert USERS synthetic users with companions and messages."""
+    def report(table, rows, rate):
+        click.echo(f'{table}: {rows} rows, {rate:.0f} rows/s')
+
+    seeder = Seeder(chunk_size=chunk_size, password=password, days=days,
+                    seed=random_seed, report=report)
+    started = time.monotonic()
+    seeder.run(users, messages=messages, companions=companions,
+               message_distribution=message_distribution,
+               companion_distribution=companion_distribution,
+               prefix=prefix, index=index)
+    for table, rows in seeder.rows.items():
+        seconds = seeder.seconds[table]
+        click.echo(f'{table}: {rows} rows in {seconds:.1f}s, '
+                   f'{rows / max(seconds, 1e-6):.0f} rows/s')
+    total = sum(rows for table, rows in seeder.rows.items()
+                if table != 'search')
+    elapsed = time.monotonic() - started
+    click.echo(f'{total} rows in {elapsed:.1f}s, '
+               f'{total / elapsed:.0f} rows/s')
+
+
+
+@bp.cli.group()
+def mail():
+    """Email delivery commands."""
+    pass
+
+@mail.command()
+@click.option('--host', default='localhost')
+@click.option('--port', default=8025)
+@click.option('--every', default=5, help='Seconds between reports.')
+def sink(host, port, every):
+    """Run a local SMTP server that accepts and discards every message.
+
+    Point MAIL_SERVER/MAIL_PORT at it to measure delivery throughput
+    without a real mail server."""
+    try:
+        from aiosmtpd.controller import Controller
+    except ImportError:
+        raise click.ClickException('The sink needs aiosmtpd installed.')
+
+    class Counter:
+        received = 0
+
+        async def handle_DATA(self, server, session, envelope):
+            self.received += 1
+            return '250 OK'
+
+    handler = Counter()
+    controller = Controller(handler, hostname=host, port=port)
+    controller.start()
+    click.echo(f'Accepting mail on {host}:{port}, Ctrl+C to stop.')
+    try:
+        last = 0
+        while True:
+            time.sleep(every)
+            received = handler.received
+            click.echo(f'{received} received, '
+                       f'{(received - last) / every:.1f} msgs/s')
+            last = received
+    except KeyboardInterrupt:
+        pass
+    finally:
+        controller.stop()
+
+@mail.command()
+@click.argument('count', default=100)
+@click.option('--to', default='sink@example.com', help='Recipient address.')
+def bench(count, to):
+    """Send COUNT test emails through the configured delivery mode."""
+    started = time.monotonic()
+    for i in range(count):
+        send_email(f'Test message {i}',
+                   sender=current_app.config['ADMINS'][0], recipients=[to],
+                   text_body='Test message.', html_body='<p>Test message.</p>')
+    if current_app.config['MAIL_DELIVERY'] == 'pool':
+        current_app.mail_pool.join()
+    elapsed = time.monotonic() - started
+    click.echo(f'{count} emails in {elapsed:.2f}s, '
+               f'{count / elapsed:.1f} msgs/s')
+    click.echo(mail_stats())
@@ -0,0 +1,110 @@
+import threading
+import time
+import sqlalchemy as sa
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats:
+    """Per-process connection pool counters, used to size gunicorn workers
+    against the database's connection limit."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pool = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.overflow_checkouts = 0
+            self.timeouts = 0
+            self.connects = 0
+            self.invalidations = 0
+
+    def record_checkout(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def record_overflow(self):
+        with self._lock:
+            self.overflow_checkouts += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_connect(self, *args):
+        with self._lock:
+            self.connects += 1
+
+    def record_invalidate(self, *args):
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'checkouts': self.checkouts,
+                'wait_avg': self.wait_total / self.checkouts
+                if self.checkouts else 0.0,
+                'wait_max': self.wait_max,
+                'overflow_checkouts': self.overflow_checkouts,
+                'timeouts': self.timeouts,
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+            }
+        if self.pool is not None:
+            stats.update(size=self.pool.size(),
+                         checked_out=self.pool.checkedout(),
+                         overflow=max(self.pool.overflow(), 0))
+        return stats
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that times each checkout, including the wait for a free
+    connection, and counts the ones that had to open a connection beyond
+    pool_size. Pools made by engine.dispose() keep the class, so they keep
+    reporting."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pool_stats.pool = self
+        # a pool made by recreate() is handed the old one's listeners
+        if kwargs.get('_dispatch') is None:
+            sa.event.listen(self, 'connect', pool_stats.record_connect)
+            sa.event.listen(self, 'invalidate', pool_stats.record_invalidate)
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            conn = super().connect()
+        except sa.exc.TimeoutError:
+            pool_stats.record_timeout()
+            raise
+        pool_stats.record_checkout(time.perf_counter() - started)
+        return conn
+
+    def _create_connection(self):
+        # a checkout only creates a connection when the pool has none idle;
+        # overflow has already been raised for it, so above zero it is one
+        # beyond pool_size. Checkouts reusing an idle one are not counted
+        conn = super()._create_connection()
+        if self.overflow() > 0:
+            pool_stats.record_overflow()
+        return conn
+
+
+def engine_options(app):
+    """SQLALCHEMY_ENGINE_OPTIONS with TimedQueuePool filled in when the
+    options configure a queue pool."""
+    options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    if 'pool_size' in options:
+        options.setdefault('poolclass', TimedQueuePool)
+    return options
@@ -0,0 +1,172 @@
+from functools import wraps
+import hashlib
+import itertools
+import threading
+import time
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+import sqlalchemy as sa
+from sqlalchemy.pool import QueuePool
+from app.cache import Cache
+
+# clients that committed recently read from the primary for
+# REPLICA_STICKY_SECONDS, so they see their own writes despite replica lag
+sticky_clients = Cache('db-sticky:', maxsize=4096)
+
+_UNDECIDED = object()
+
+
+class ReplicaSet:
+    """Engines for the read replicas, picked round robin. A replica that
+    fails a health check or drops a connection is skipped for
+    REPLICA_RETRY_INTERVAL seconds; healthy ones are re-checked with a
+    SELECT 1 every REPLICA_CHECK_INTERVAL seconds."""
+
+    def __init__(self, app):
+        options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        if 'pool_size' in options:
+            # pool telemetry covers the primary only
+            options['poolclass'] = QueuePool
+        self.engines = [sa.create_engine(url, **options)
+                        for url in app.config['SQLALCHEMY_REPLICA_URIS']]
+        self.check_interval = app.config['REPLICA_CHECK_INTERVAL']
+        self.retry_interval = app.config['REPLICA_RETRY_INTERVAL']
+        self.logger = app.logger
+        self._checked_at = [0.0] * len(self.engines)
+        self._down_until = [0.0] * len(self.engines)
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        for i, engine in enumerate(self.engines):
+            sa.event.listen(engine, 'handle_error', self._on_error(i))
+
+    def _on_error(self, i):
+        def handle_error(context):
+            if context.is_disconnect or isinstance(
+                    context.sqlalchemy_exception, sa.exc.OperationalError):
+                self.mark_down(i)
+        return handle_error
+
+    def mark_down(self, i):
+        self.logger.warning('Read replica %d is unhealthy', i)
+        with self._lock:
+            self._down_until[i] = time.monotonic() + self.retry_interval
+
+    def _healthy(self, i):
+        now = time.monotonic()
+        if self._down_until[i] > now:
+            return False
+        if now - self._checked_at[i] < self.check_interval:
+            return True
+        try:
+            with self.engines[i].connect() as conn:
+                conn.execute(sa.text('SELECT 1'))
+        except sa.exc.SQLAlchemyError:
+            self.mark_down(i)
+            return False
+        self._checked_at[i] = now
+        return True
+
+    def choose(self):
+        """Return a healthy replica engine, or None to use the primary."""
+        for _ in range(len(self.engines)):
+            i = next(self._next) % len(self.engines)
+            if self._healthy(i):
+                return self.engines[i]
+        return None
+
+    def stats(self):
+        now = time.monotonic()
+        return [{'url': engine.url.render_as_string(hide_password=True),
+                 'healthy': self._down_until[i] <= now,
+                 'checked_out': engine.pool.checkedout()
+                 if isinstance(engine.pool, QueuePool) else None}
+                for i, engine in enumerate(self.engines)]
+
+
+def read_replica(f):
+    """Send this view's reads to a replica, whatever the request method."""
+    f.db_routing = 'replica'
+    return f
+
+
+def use_primary(f):
+    """Keep this view on the primary, for GET views that write."""
+    f.db_routing = 'primary'
+    return f
+
+
+def _client_key():
+    # the Flask-Login session or the API token identify the client without
+    # a database lookup, which would itself need routing
+    user_id = session.get('_user_id')
+    if user_id:
+        return f'u:{user_id}'
+    auth = request.headers.get('Authorization')
+    if auth:
+        return 't:' + hashlib.sha1(auth.encode('utf-8')).hexdigest()
+    return None
+
+
+def _choose_replica():
+    replicas = current_app.db_replicas
+    if not replicas.engines:
+        return None
+    view = current_app.view_functions.get(request.endpoint)
+    routing = getattr(view, 'db_routing', None)
+    if routing == 'primary':
+        return None
+    if routing != 'replica' and not (
+            current_app.config['REPLICA_ROUTE_GETS']
+            and request.method in ('GET', 'HEAD')):
+        return None
+    key = _client_key()
+    if key and sticky_clients.get_many(key)[0]:
+        return None
+    return replicas.choose()
+
+
+def request_replica():
+    """The replica engine the current request reads from, or None. Decided
+    once per request so all its reads see the same snapshot."""
+    if not has_request_context():
+        return None
+    replica = g.get('_db_replica', _UNDECIDED)
+    if replica is _UNDECIDED:
+        replica = g._db_replica = _choose_replica()
+    return replica
+
+
+def reads_from_replica(session):
+    """Whether session's next read goes to a replica, which may lag behind
+    the primary. Shared caches must not be filled from such reads."""
+    return not session.info.get('db_wrote') and request_replica() is not None
+
+
+class RoutingSession(Session):
+    """Session that reads from a replica when the request allows it. Writes,
+    and every read after the first write, go to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or isinstance(
+                    clause, (sa.sql.dml.UpdateBase, sa.sql.elements.TextClause)):
+                self.info['db_wrote'] = True
+            elif not self.info.get('db_wrote'):
+                replica = request_replica()
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+def after_commit(session):
+    if not session.info.pop('db_wrote', False) or not has_request_context():
+        return
+    g._db_replica = None
+    key = _client_key()
+    if key and current_app.db_replicas.engines:
+        sticky_clients.set(key, 1, current_app.config['REPLICA_STICKY_SECONDS'])
+
+
+def after_rollback(session):
+    session.info.pop('db_wrote', None)
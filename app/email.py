@@ -1,13 +1,120 @@
-from threading import Thread
+import atexit
+import queue
+import smtplib
+import threading
+import time
+import redis
 from flask import current_app
 from flask_mail import Message
 from flask_babel import _
+from rq import Retry
 from app import mail
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class MailPool:
+    """Bounded pool of sender threads fed from a bounded queue. A thread
+    keeps one SMTP connection open for as long as mail keeps arriving
+    within MAIL_POOL_IDLE seconds, so a burst costs one connection per
+    thread instead of one per message. Failed messages are put back with
+    exponential backoff up to MAIL_MAX_RETRIES times."""
+
+    def __init__(self, app):
+        self.app = app
+        self.size = app.config['MAIL_POOL_SIZE']
+        self.idle = app.config['MAIL_POOL_IDLE']
+        self.max_retries = app.config['MAIL_MAX_RETRIES']
+        self.queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_MAX'])
+        self.sent = self.retried = self.failed = self.connections = 0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, msg):
+        # blocks while the queue is full, which pushes back on the caller
+        # instead of growing without bound
+        self._ensure_threads()
+        self.queue.put((msg, 0))
+
+    def _ensure_threads(self):
+        if self._threads:
+            return
+        with self._lock:
+            if not self._threads:
+                for i in range(self.size):
+                    thread = threading.Thread(target=self._run, daemon=True,
+                                              name=f'mail-sender-{i}')
+                    thread.start()
+                    self._threads.append(thread)
+                atexit.register(self.join, timeout=10)
+
+    def _next(self):
+        try:
+            return self.queue.get(timeout=self.idle)
+        except queue.Empty:
+            return None
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                item = self.queue.get()
+                try:
+                    with mail.connect() as conn:
+                        self.connections += 1
+                        while item is not None:
+                            conn.send(item[0])
+                            self.sent += 1
+                            self.queue.task_done()
+                            item = self._next()
+                except (smtplib.SMTPException, OSError):
+                    if item is not None:
+                        self._retry(*item)
+                except Exception:
+                    # not something a retry fixes (e.g. a bad message)
+                    if item is not None:
+                        self._retry(item[0], self.max_retries)
+
+    def _retry(self, msg, attempts):
+        if attempts < self.max_retries:
+            self.retried += 1
+            self.app.logger.warning('Sending email failed, retrying',
+                                    exc_info=True)
+            time.sleep(min(2 ** attempts, 30))
+            try:
+                self.queue.put_nowait((msg, attempts + 1))
+            except queue.Full:
+                self.failed += 1
+                self.app.logger.error('Mail queue full, dropping email')
+        else:
+            self.failed += 1
+            self.app.logger.error('Sending email failed, giving up',
+                                  exc_info=True)
+        self.queue.task_done()
+
+    def join(self, timeout=None):
+        """Wait until everything queued so far is sent or given up on.
+        Returns False if timeout seconds passed first."""
+        deadline = time.monotonic() + timeout if timeout else None
+        while self.queue.unfinished_tasks:
+            if deadline and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'threads': len(self._threads),
+                'connections': self.connections, 'sent': self.sent,
+                'retried': self.retried, 'failed': self.failed}
+
+
+def mail_stats():
+    app = current_app._get_current_object()
+    stats = {'delivery': app.config['MAIL_DELIVERY'],
+             'pool': app.mail_pool.stats()}
+    try:
+        stats['queue'] = {'queued': app.mail_queue.count,
+                          'failed': app.mail_queue.failed_job_registry.count}
+    except redis.exceptions.RedisError:
+        stats['queue'] = None
+    return stats
 
 def send_email(subject, sender, recipients, text_body, html_body,
                attachments=None, sync=False):
@@ -19,6 +126,12 @@ def send_email(subject, sender, recipients, text_body, html_body,
             msg.attach(*attachment)
     if sync:
         mail.send(msg)
+    elif current_app.config['MAIL_DELIVERY'] == 'rq':
+        # web workers never talk to SMTP; the mail worker sends it
+        retries = current_app.config['MAIL_MAX_RETRIES']
+        current_app.mail_queue.enqueue(
+            'app.tasks.send_queued_email', msg,
+            retry=Retry(max=retries, interval=[2 ** i for i in range(retries)])
+            if retries else None)
     else:
-        Thread(target=send_async_email,
-               args=(current_app._get_current_object(), msg)).start()
\ No newline at end of file
+        current_app.mail_pool.submit(msg)
@@ -0,0 +1,66 @@
+import gzip
+import json
+import os
+import time
+from flask import current_app
+
+
+def export_dir(user_id):
+    return os.path.join(current_app.config['EXPORT_DIR'], str(user_id))
+
+
+def write_json_export(path, key, rows, compress=False):
+    """Stream rows (dicts) to path as {key: [row, ...]}, one row at a time,
+    so the export never has to fit in memory. The file is written under a
+    temporary name and renamed once complete. Returns the number of rows."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + '.part'
+    opener = gzip.open if compress else open
+    count = 0
+    try:
+        with opener(partial, 'wt', encoding='utf-8') as f:
+            f.write('{' + json.dumps(key) + ': [')
+            for row in rows:
+                f.write(',\n    ' if count else '\n    ')
+                f.write(json.dumps(row))
+                count += 1
+            f.write('\n]}\n')
+        os.replace(partial, path)
+    except BaseException:
+        # also covers the task's timeout, so no half-written file is left
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return count
+
+
+def remove_previous_exports(user_id, keep):
+    """Delete the user's finished exports other than the file named keep,
+    so each user has at most one on disk."""
+    directory = export_dir(user_id)
+    for name in os.listdir(directory):
+        if name != keep and not name.endswith('.part'):
+            os.remove(os.path.join(directory, name))
+
+
+def prune_exports(max_age):
+    """Delete export files older than max_age seconds, and the directories
+    they leave empty. Returns the number of files deleted."""
+    root = current_app.config['EXPORT_DIR']
+    cutoff = time.time() - max_age
+    deleted = 0
+    if not os.path.isdir(root):
+        return deleted
+    for user_dir in os.scandir(root):
+        if not user_dir.is_dir():
+            continue
+        for entry in os.scandir(user_dir.path):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                deleted += 1
+        try:
+            os.rmdir(user_dir.path)
+        except OSError:
+            # not empty
+            pass
+    return deleted
@@ -0,0 +1,124 @@
+import multiprocessing
+import time
+from flask import current_app
+import redis
+import sqlalchemy as sa
+from langdetect import detector_factory
+from langdetect.lang_detect_exception import LangDetectException
+from app import db
+
+DETECT_SCHEDULED_KEY = 'langdetect:scheduled'
+DETECT_PENDING_KEY = 'langdetect:pending'
+
+
+def load_detector(seed=None):
+    """Load the language profiles, once per process. Detection is randomized,
+    so the seed is fixed to give the same answer for the same text. Workers
+    started with `flask worker` load them before forking, so jobs don't each
+    pay for it."""
+    detector_factory.init_factory()
+    factory = detector_factory._factory
+    factory.set_seed(current_app.config['LANGDETECT_SEED']
+                     if seed is None else seed)
+    return factory
+
+
+def detect_language(text, factory=None):
+    """The language code for text, or '' when it cannot be told."""
+    detector = (factory or load_detector()).create()
+    detector.append(text)
+    try:
+        return detector.detect()
+    except LangDetectException:
+        return ''
+
+
+def _detect_loaded(text):
+    # runs in pool processes forked after load_detector()
+    return detect_language(text, detector_factory._factory)
+
+
+def _detect_rows(rows, pool=None):
+    # rows of (id, body); every language goes back in one UPDATE ... CASE
+    from app.models import Message
+    if not rows:
+        return 0
+    factory = load_detector()
+    bodies = [row.body or '' for row in rows]
+    detected = pool.map(_detect_loaded, bodies) if pool else \
+        [detect_language(body, factory) for body in bodies]
+    languages = dict(zip((row.id for row in rows), detected))
+    db.session.execute(
+        sa.update(Message).where(Message.id.in_(languages)).values(
+            language=sa.case(languages, value=Message.id)),
+        execution_options={'synchronize_session': False})
+    db.session.commit()
+    return len(rows)
+
+
+def _undetected(*criteria):
+    from app.models import Message
+    return sa.select(Message.id, Message.body).where(
+        Message.language.is_(None), *criteria)
+
+
+def detect_queued(batch_size):
+    """Detect the languages of the messages queued by
+    schedule_language_detection, batch_size per UPDATE. Messages that cannot
+    be told are set to '' so nothing picks them up again. Returns the number
+    of messages processed."""
+    from app.models import Message
+    total = 0
+    while True:
+        ids = [int(id) for id in current_app.redis.spop(DETECT_PENDING_KEY,
+                                                        batch_size) or ()]
+        if not ids:
+            return total
+        total += _detect_rows(db.session.execute(
+            _undetected(Message.id.in_(ids))).all())
+
+
+def detect_all(batch_size, workers=1, report=None, report_every=5):
+    """Detect the language of every message that has none, walking the
+    table in id order batch_size rows at a time. Detection is CPU bound, so
+    with workers above 1 it is spread over that many forked processes.
+    report(messages, messages_per_second) is called every report_every
+    seconds and at the end. Returns the number of messages processed."""
+    from app.models import Message
+    load_detector()
+    pool = multiprocessing.get_context('fork').Pool(workers) \
+        if workers > 1 else None
+    started = last_report = time.monotonic()
+    total = last_id = 0
+    try:
+        while True:
+            rows = db.session.execute(_undetected(
+                Message.id > last_id).order_by(Message.id).limit(
+                batch_size)).all()
+            total += _detect_rows(rows, pool)
+            now = time.monotonic()
+            done = len(rows) < batch_size
+            if report and (done or now - last_report >= report_every):
+                last_report = now
+                report(total, total / max(now - started, 1e-6))
+            if done:
+                return total
+            last_id = rows[-1].id
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def schedule_language_detection(ids):
+    # the ids wait in a Redis set and at most one job is queued at a time to
+    # work through it, like the search outbox drain. Messages that never make
+    # it into the set keep a NULL language until `flask languages backfill`
+    try:
+        with current_app.redis.pipeline() as pipe:
+            pipe.sadd(DETECT_PENDING_KEY, *ids)
+            pipe.set(DETECT_SCHEDULED_KEY, 1, nx=True, ex=60)
+            if pipe.execute()[1]:
+                current_app.task_queue.enqueue(
+                    'app.tasks.detect_message_languages')
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not schedule language detection')
@@ -1,26 +1,44 @@
 from datetime import datetime, timezone
 from flask import render_template, flash, redirect, url_for, request, g, \
-    current_app
+    current_app, abort, Response, stream_with_context, send_from_directory
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 import sqlalchemy as sa
-from langdetect import detect, LangDetectException
+import redis
 from app import db
+from app.presence import record_last_seen
+from app.db_routing import read_replica, use_primary
+from app.avatars import DIGEST_RE, identicon, identicon_etag
+from app.exports import export_dir
+from app.notifications import notification_channel, notification_events, \
+    open_stream_slot, close_stream_slot
+from app.pagination import keyset_paginate, offset_paginate
 from app.main.forms import EditProfileForm, EmptyForm, CreateCompanionForm, SearchForm, MessageForm
-from app.models import User, Companion, Message, Notification
-# we havent built this one yet (no free translate API sadge)
-# from app.translate import translate
+from app.models import User, Companion, Message, Notification, \
+    loader_options
+from app.translate import translate, translate_many, TranslationError
+from app.api.errors import error_response
 from app.main import bp
 
 @bp.before_app_request
 def before_request():
+    if request.endpoint == 'main.avatar':
+        # public and cached by browsers, don't load the user for it
+        return
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        record_last_seen(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
+@bp.app_context_processor
+def inject_tasks_in_progress():
+    # base.html lists unfinished tasks above every page. A callable, so
+    # fragments and other templates that don't extend it pay nothing;
+    # read-only, since the worker marks tasks complete
+    return {'tasks_in_progress': lambda: current_user.get_task_progress()}
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
@@ -41,21 +59,27 @@ def index():
         db.session.commit()
         flash(_('Your new AI Companion has been created!'))
         return redirect(url_for('main.index'))
-    companions = db.session.scalars(sa.Select(Companion).where(Companion.associated_user_id == current_user.id)).all()
+    companions = db.session.scalars(sa.Select(Companion).where(
+        Companion.associated_user_id == current_user.id).options(
+        *loader_options('companion_list'))).all()
     return render_template('index.html', title=_('Home'), form=form, companions=companions)
 
 @bp.route('/user/<username>')
 @login_required
+@read_replica
 def user(username):
-    user = db.first_or_404(sa.select(User).where(User.username == username))
+    user = User.get_by_username(username) or abort(404)
     form = EmptyForm()
     return render_template('user.html', user=user, form=form)
 
 @bp.route('/user/<username>/popup')
 @login_required
+@read_replica
 def user_popup(username):
-    user = db.first_or_404(sa.select(User).where(User.username == username))
-    companions = db.session.scalars(sa.select(Companion).join(User.companions).where(User.username == username).order_by(Companion.created_at_ts)).all()
+    user = User.get_by_username(username) or abort(404)
+    companions = db.session.scalars(user.companions.select().order_by(
+        Companion.created_at_ts).options(
+        *loader_options('companion_list'))).all()
     form = EmptyForm()
     return render_template('user_popup.html', user=user, form=form, companions=companions)
 
@@ -77,71 +101,196 @@ def edit_profile():
 
 @bp.route('/messages')
 @login_required
+@use_primary
 def messages():
     current_user.last_message_read_time = datetime.now(timezone.utc)
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    query = current_user.messages_received.select().order_by(
-        Message.timestamp.desc())
-    messages = db.paginate(query, page=page,
-                           per_page=current_app.config['ITEMS_PER_PAGE'],
-                           error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
-    return render_template('messages.html', messages=messages.items,
+    per_page = current_app.config['ITEMS_PER_PAGE']
+    query = current_user.messages_received.select().options(
+        *loader_options('message_list'))
+    if 'page' in request.args:
+        page = request.args.get('page', 1, type=int)
+        messages, has_next = offset_paginate(
+            query.order_by(Message.timestamp.desc(), Message.id.desc()),
+            page, per_page)
+        next_url = url_for('main.messages', page=page + 1) \
+            if has_next else None
+        prev_url = url_for('main.messages', page=page - 1) \
+            if page > 1 else None
+    else:
+        messages, next_cursor, prev_cursor = keyset_paginate(
+            query, [Message.timestamp, Message.id],
+            request.args.get('cursor'), per_page, descending=True)
+        next_url = url_for('main.messages', cursor=next_cursor) \
+            if next_cursor else None
+        prev_url = url_for('main.messages', cursor=prev_cursor) \
+            if prev_cursor else None
+    return render_template('messages.html', messages=messages,
                            next_url=next_url, prev_url=prev_url)
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
 def send_message(recipient):
-    user = db.first_or_404(sa.select(User).where(User.username == recipient))
+    user = User.get_by_username(recipient) or abort(404)
     form = MessageForm()
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
         db.session.add(msg)
+        db.session.flush()
         user.add_notification('unread_message_count',
-                              user.unread_message_count())
+                              user.unread_message_count)
         db.session.commit()
         flash(_('Your message has been sent.'))
         return redirect(url_for('main.user', username=recipient))
     return render_template('send_message.html', title=_('Send Message'),
                            form=form, recipient=recipient)
 
-@bp.route('/notifications')
-@login_required
-def notifications():
-    since = request.args.get('since', 0.0, type=float)
+def _notifications_since(since):
     query = current_user.notifications.select().where(
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    notifications = db.session.scalars(query)
     return [{
         'name': n.name,
         'data': n.get_data(),
         'timestamp': n.timestamp
-    } for n in notifications]
+    } for n in db.session.scalars(query)]
+
+# polling fallback for clients that cannot keep the event stream open
+@bp.route('/notifications')
+@login_required
+def notifications():
+    since = request.args.get('since', 0.0, type=float)
+    return _notifications_since(since)
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    if not open_stream_slot(current_app.config['NOTIFICATION_STREAM_MAX']):
+        abort(503)
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    try:
+        # subscribe before reading the backlog so nothing slips in between
+        pubsub.subscribe(notification_channel(current_user.id))
+        backlog = _notifications_since(since)
+    except BaseException as e:
+        pubsub.close()
+        close_stream_slot()
+        if isinstance(e, redis.exceptions.RedisError):
+            abort(503)
+        raise
+    # don't hold a pooled connection for the lifetime of the stream
+    db.session.close()
+    events = notification_events(
+        pubsub, backlog, since,
+        timeout=current_app.config['NOTIFICATION_STREAM_TIMEOUT'])
+    response = Response(stream_with_context(events),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+    # runs even if the client goes away before the stream starts
+    response.call_on_close(close_stream_slot)
+    return response
 
 @bp.route('/export_companions')
 @login_required
+@use_primary
 def export_companions():
-    if current_user.get_task_in_progress('export_companions'):
+    if current_user.get_task_in_progress('export_companions',
+                                         mark_complete=True):
         flash(_('An export task is currently in progress, please try again later.'))
     else:
         current_user.launch_task('export_companions', _('Exporting companion list...'))
-        db.session.commit()
+    db.session.commit()
     return redirect(url_for('main.user', username=current_user.username))
 
-# currently not implemented! It costs money
+@bp.route('/tasks')
+@login_required
+def tasks():
+    return {'tasks': [{'id': task.id, 'name': task.name,
+                       'description': task.description, 'progress': progress}
+                      for task, progress in current_user.get_task_progress()]}
+
+@bp.route('/exports/<filename>')
+@login_required
+def download_export(filename):
+    # exports live in a directory per user, so nobody can fetch another
+    # user's file by guessing its name
+    return send_from_directory(export_dir(current_user.id), filename,
+                               as_attachment=True)
+
+# the digest is of the email, so a changed email gets a new URL and the image
+# at any one URL never changes
+@bp.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    if current_app.config['AVATAR_PROVIDER'] != 'local' or \
+            not DIGEST_RE.match(digest) or \
+            size not in current_app.config['AVATAR_SIZES']:
+        abort(404)
+    etag = identicon_etag(digest, size)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(identicon(digest, size), mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['AVATAR_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
+def _visible_messages(ids):
+    # id, body and language of the messages among ids the current user sent
+    # or received; others' messages are never translated for them
+    return db.session.execute(sa.select(
+        Message.id, Message.body, Message.language).where(
+        Message.id.in_(ids), sa.or_(Message.recipient_id == current_user.id,
+                                    Message.sender_id == current_user.id)))
+
+# translates one stored message: {'id': 1, 'dest_language': 'en'}
 @bp.route('/translate', methods=['POST'])
 @login_required
 def translate_text():
-    data = request.get_json()
-    return {'text': translate(data['text'],
-                              data['source_language'],
-                              data['dest_language'])}
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('id'), int) or not data.get('dest_language'):
+        return error_response(400)
+    message = _visible_messages([data['id']]).first()
+    if message is None or not message.language:
+        return error_response(404)
+    try:
+        return {'text': translate(message.body, message.language,
+                                  data['dest_language'])}
+    except TranslationError as e:
+        current_app.logger.warning('Translation failed: %s', e)
+        return error_response(503)
+
+# translates every foreign message on a page: {'dest_language': 'en',
+# 'ids': [1, 2, ...]}. The bodies and their languages are looked up here, so
+# only stored messages are ever sent to the provider
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_batch():
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not data.get('dest_language') or \
+            len(ids) > current_app.config['TRANSLATION_BATCH_MAX'] or \
+            not all(isinstance(id, int) for id in ids):
+        return error_response(400)
+    by_source = {}
+    for id, body, language in _visible_messages(ids):
+        if language and language != data['dest_language']:
+            by_source.setdefault(language, []).append((id, body))
+    translations = {}
+    try:
+        for source, group in by_source.items():
+            texts = translate_many([body for _, body in group], source,
+                                   data['dest_language'])
+            translations.update(zip((str(id) for id, _ in group), texts))
+    except TranslationError as e:
+        current_app.logger.warning('Translation failed: %s', e)
+        return error_response(503)
+    return {'translations': translations}
 
 # functionality technically exists, but there is no destination for this to search!
 @bp.route('/search')
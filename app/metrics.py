@@ -0,0 +1,209 @@
+from contextlib import contextmanager
+import hmac
+import ipaddress
+import os
+import threading
+import time
+from flask import Blueprint, Response, abort, current_app, g, \
+    has_app_context, has_request_context, request
+from elasticsearch import Elasticsearch
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, \
+    Histogram, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from redis import Redis
+from redis.client import Pipeline
+import sqlalchemy as sa
+
+# Per-request counts and timings of SQL statements, Redis round trips and
+# Elasticsearch requests. With gunicorn, set PROMETHEUS_MULTIPROC_DIR so the
+# workers' histograms are merged when /metrics is scraped.
+bp = Blueprint('metrics', __name__)
+
+KINDS = ('sql', 'redis', 'es')
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+REQUEST_SECONDS = Histogram(
+    'app_request_duration_seconds', 'Request latency',
+    ['endpoint', 'method'])
+REQUEST_CALLS = {kind: Histogram(
+    f'app_request_{kind}_calls', f'{kind} calls per request', ['endpoint'],
+    buckets=COUNT_BUCKETS) for kind in KINDS}
+REQUEST_CALL_SECONDS = {kind: Histogram(
+    f'app_request_{kind}_seconds', f'Time spent in {kind} per request',
+    ['endpoint']) for kind in KINDS}
+CALL_SECONDS = {kind: Histogram(
+    f'app_{kind}_call_duration_seconds', f'Latency of single {kind} calls')
+    for kind in KINDS}
+
+
+def _record(kind, elapsed):
+    CALL_SECONDS[kind].observe(elapsed)
+    if has_request_context() and '_metrics' in g:
+        calls = g._metrics[kind]
+        calls[0] += 1
+        calls[1] += elapsed
+
+
+@contextmanager
+def timed(kind):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(kind, time.perf_counter() - started)
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        with timed('redis'):
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(Redis):
+    """Redis client that times every round trip; a pipeline counts as one."""
+
+    def execute_command(self, *args, **options):
+        with timed('redis'):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool,
+                                    self.response_callbacks, transaction,
+                                    shard_hint)
+
+
+class InstrumentedElasticsearch(Elasticsearch):
+    def perform_request(self, *args, **kwargs):
+        with timed('es'):
+            return super().perform_request(*args, **kwargs)
+
+
+@sa.event.listens_for(sa.engine.Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@sa.event.listens_for(sa.engine.Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    _record('sql', elapsed)
+    threshold = current_app.config['SLOW_QUERY_THRESHOLD'] \
+        if has_app_context() else None
+    if threshold and elapsed >= threshold:
+        current_app.logger.warning('Slow query ({0:.3f}s): {1}'.format(
+            elapsed, ' '.join(statement.split())))
+
+
+@bp.before_app_request
+def _start_request():
+    g._metrics = {kind: [0, 0.0] for kind in KINDS}
+    g._metrics_started = time.perf_counter()
+
+
+@bp.after_app_request
+def _finish_request(response):
+    if '_metrics' not in g or request.endpoint == 'metrics.metrics':
+        return response
+    elapsed = time.perf_counter() - g._metrics_started
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_SECONDS.labels(endpoint, request.method).observe(elapsed)
+    for kind, (calls, seconds) in g._metrics.items():
+        REQUEST_CALLS[kind].labels(endpoint).observe(calls)
+        REQUEST_CALL_SECONDS[kind].labels(endpoint).observe(seconds)
+    threshold = current_app.config['SLOW_REQUEST_THRESHOLD']
+    if threshold and elapsed >= threshold:
+        current_app.logger.warning(
+            'Slow request {0} {1} ({2:.3f}s): {3}'.format(
+                request.method, request.path, elapsed, ', '.join(
+                    '{0} {1} in {2:.3f}s'.format(kind, calls, seconds)
+                    for kind, (calls, seconds) in g._metrics.items())))
+    return response
+
+
+_outbox_lock = threading.Lock()
+_outbox_stats = (0.0, None)
+
+
+def _search_outbox_stats():
+    # scrapes come from every Prometheus replica every few seconds; the
+    # outbox is queried at most once per METRICS_DB_INTERVAL per process.
+    # Returns (pending, lag, parked)
+    global _outbox_stats
+    from app.models import SearchOutbox
+    with _outbox_lock:
+        expires, stats = _outbox_stats
+        if stats is None or expires <= time.monotonic():
+            stats = SearchOutbox.lag() + (SearchOutbox.parked_count(),)
+            _outbox_stats = (time.monotonic() +
+                             current_app.config['METRICS_DB_INTERVAL'], stats)
+    return stats
+
+
+class ProcessCollector:
+    """Gauges read at scrape time from the process serving the scrape:
+    cache hit counts, connection pool state and search outbox lag and
+    parked entries, the last two cached for METRICS_DB_INTERVAL seconds."""
+
+    def collect(self):
+        from app.cache import Cache
+        from app.db_pool import pool_stats
+        pid = str(os.getpid())
+        cache = GaugeMetricFamily('app_cache_lookups', 'Cache lookups',
+                                  labels=['pid', 'cache', 'result'])
+        for instance in Cache.instances:
+            name = instance.prefix.rstrip(':')
+            cache.add_metric([pid, name, 'hit'], instance.hits)
+            cache.add_metric([pid, name, 'miss'], instance.misses)
+        yield cache
+        pool = GaugeMetricFamily('app_db_pool', 'Connection pool state',
+                                 labels=['pid', 'stat'])
+        for stat, value in pool_stats.stats().items():
+            pool.add_metric([pid, stat], value)
+        yield pool
+        pending, lag, parked = _search_outbox_stats()
+        yield GaugeMetricFamily('app_search_outbox_pending',
+                                'Search outbox entries waiting',
+                                value=pending)
+        yield GaugeMetricFamily('app_search_outbox_lag_seconds',
+                                'Age of the oldest search outbox entry',
+                                value=lag)
+        yield GaugeMetricFamily('app_search_outbox_parked',
+                                'Search outbox entries parked after '
+                                'repeated failures', value=parked)
+
+
+class DefaultMetrics:
+    # this process's metrics from the default registry, for a scrape
+    # registry that also carries ProcessCollector
+    def collect(self):
+        return REGISTRY.collect()
+
+
+def _scrape_allowed():
+    # from METRICS_ALLOWED_IPS, or anywhere with the METRICS_TOKEN bearer
+    token = current_app.config['METRICS_TOKEN']
+    auth = request.headers.get('Authorization', '')
+    if token and hmac.compare_digest(auth.encode('utf-8'),
+                                     f'Bearer {token}'.encode('utf-8')):
+        return True
+    try:
+        address = ipaddress.ip_address(request.remote_addr)
+    except (TypeError, ValueError):
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False)
+               for network in current_app.config['METRICS_ALLOWED_IPS'])
+
+
+@bp.route('/metrics')
+def metrics():
+    if not _scrape_allowed():
+        abort(403)
+    registry = CollectorRegistry()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(DefaultMetrics())
+    registry.register(ProcessCollector())
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
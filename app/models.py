@@ -1,17 +1,26 @@
 from datetime import datetime, timezone, timedelta
-from hashlib import md5
 import json
 import secrets
-from time import time
+from time import monotonic, sleep, time
 from typing import Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from flask import current_app, url_for
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import cached_query_index, index_action, delete_action, \
+	bulk_index, schedule_outbox_drain, reindex
+from app.presence import buffered_last_seen, buffered_last_seen_many
+from app.pagination import keyset_paginate, offset_paginate, cached_count
+from app.cache import Cache, snapshot, restore
+from app.db_routing import reads_from_replica
+from app.avatars import avatar_digest, avatar_url
+from app.language import schedule_language_detection
+from app.notifications import publish_pending_notifications, \
+	discard_pending_notifications
 import redis
 import rq
 
@@ -27,7 +36,8 @@ class Base(so.DeclarativeBase):
 class SearchableMixin(object):
     @classmethod
     def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total = cached_query_index(cls.__tablename__, expression, page,
+                                        per_page)
         if total == 0:
             return [], 0
         when = []
@@ -35,57 +45,136 @@ class SearchableMixin(object):
             when.append((ids[i], i))
         query = sa.select(cls).where(cls.id.in_(ids)).order_by(
             db.case(*when, value=cls.id))
+        if getattr(cls, '__search_profile__', None):
+            query = query.options(*loader_options(cls.__search_profile__))
         return db.session.scalars(query), total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def model_for(cls, index):
+        for mapper in db.Model.registry.mappers:
+            model = mapper.class_
+            if issubclass(model, cls) and model.__tablename__ == index:
+                return model
+        raise LookupError(index)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        # Elasticsearch changes go to the outbox in the same transaction as
+        # the rows themselves and an RQ job ships them after the commit; the
+        # embedded index is cheap enough to update right after the commit
+        backend = current_app.search_backend
+        if not backend:
+            return
+        now = time()
+        entries = []
+        for op, objs in (('index', session.new), ('index', session.dirty),
+                         ('delete', session.deleted)):
+            for obj in objs:
+                if isinstance(obj, SearchableMixin) and (
+                        op == 'delete' or session.is_modified(obj)):
+                    entries.append((op, obj))
+        if not entries:
+            return
+        if backend.uses_outbox:
+            session.connection().execute(
+                sa.insert(SearchOutbox.__table__),
+                [{'index': obj.__tablename__, 'object_id': obj.id, 'op': op,
+                  'created_at': now} for op, obj in entries])
+            session.info['search_outbox'] = True
+        else:
+            session.info.setdefault('search_actions', []).extend(
+                index_action(obj.__tablename__, obj) if op == 'index'
+                else delete_action(obj.__tablename__, obj.id)
+                for op, obj in entries)
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        if session.info.pop('search_outbox', False):
+            schedule_outbox_drain()
+        actions = session.info.pop('search_actions', None)
+        if actions:
+            try:
+                bulk_index(actions)
+            except Exception:
+                current_app.logger.exception('Search index update failed')
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_actions', None)
 
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, **kwargs):
+        return reindex(cls, **kwargs)
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+db.event.listen(db.session, 'after_commit', publish_pending_notifications)
+db.event.listen(db.session, 'after_rollback', discard_pending_notifications)
+
+# token -> snapshot of the owning User, so API auth can skip the lookup by
+# token. Columns written outside the ORM (counters, last_seen) and the
+# password hash are left out and load lazily if a view needs them.
+token_cache = Cache('token:', maxsize=4096)
+TOKEN_SNAPSHOT_EXCLUDE = ('password_hash', 'last_seen', 'companion_count',
+                          'unread_message_count')
+
+# id -> version-stamped User snapshot and username -> id, for load_user and
+# the profile/popup/message views. Counter bumps and presence flushes
+# invalidate entries too, so the snapshot can carry those columns.
+user_cache = Cache('user:', maxsize=4096)
+USER_SNAPSHOT_EXCLUDE = ('password_hash',)
 
 class PaginatedAPIMixin(object):
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        resources = db.paginate(query, page=page, per_page=per_page,
-                                error_out=False)
+    @classmethod
+    def to_dicts(cls, items):
+        return [item.to_dict() for item in items]
+
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, **kwargs):
+        items, has_next = offset_paginate(query, page, per_page)
+        total = cached_count(endpoint + json.dumps(kwargs, sort_keys=True),
+                             query)
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': cls.to_dicts(items),
             '_meta': {
                 'page': page,
                 'per_page': per_page,
-                'total_pages': resources.pages,
-                'total_items': resources.total
+                'total_pages': -(-total // per_page),
+                'total_items': total
             },
             '_links': {
                 'self': url_for(endpoint, page=page, per_page=per_page,
                                 **kwargs),
                 'next': url_for(endpoint, page=page + 1, per_page=per_page,
-                                **kwargs) if resources.has_next else None,
+                                **kwargs) if has_next else None,
                 'prev': url_for(endpoint, page=page - 1, per_page=per_page,
-                                **kwargs) if resources.has_prev else None
+                                **kwargs) if page > 1 else None
+            }
+        }
+        return data
+
+    @classmethod
+    def to_cursor_collection_dict(cls, query, columns, cursor, per_page,
+                                  endpoint, **kwargs):
+        resources = keyset_paginate(query, columns, cursor, per_page)
+        total = cached_count(endpoint + json.dumps(kwargs, sort_keys=True),
+                             query)
+        data = {
+            'items': cls.to_dicts(resources.items),
+            '_meta': {
+                'per_page': per_page,
+                'total_items': total
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page,
+                                **kwargs),
+                'next': url_for(endpoint, cursor=resources.next_cursor,
+                                per_page=per_page, **kwargs)
+                    if resources.next_cursor else None,
+                'prev': url_for(endpoint, cursor=resources.prev_cursor,
+                                per_page=per_page, **kwargs)
+                    if resources.prev_cursor else None
             }
         }
         return data
@@ -110,6 +199,11 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 	password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
 	about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
 	pref_language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
+	# md5 of the normalized email, kept in step by _update_avatar_digest so
+	# rendering an avatar doesn't hash it again; indexed for /avatar, which
+	# only caches images of digests that belong to someone
+	avatar_digest: so.Mapped[Optional[str]] = so.mapped_column(
+		sa.String(32), index=True)
 
 	#user_tz: so.Mapped[Optional[datetime]] = so.mapped_column(default=lambda: timezone.utc)
 	#last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(default=lambda: datetime.now(user_tz))
@@ -118,6 +212,12 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 	token: so.Mapped[Optional[str]] = so.mapped_column(
 		sa.String(32), index=True, unique=True)
 	token_expiration: so.Mapped[Optional[datetime]]
+	# denormalized counters, kept in step by the flush hooks further down and
+	# repaired in bulk by `flask counters reconcile`
+	companion_count: so.Mapped[int] = so.mapped_column(
+		default=0, server_default='0')
+	unread_message_count: so.Mapped[int] = so.mapped_column(
+		default=0, server_default='0')
 
 	companions: so.WriteOnlyMapped['Companion'] = so.relationship(
 		back_populates='creator',
@@ -156,9 +256,13 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 	def check_password(self, password):
 		return check_password_hash(self.password_hash, password)
 
+	@so.validates('email')
+	def _update_avatar_digest(self, key, email):
+		self.avatar_digest = avatar_digest(email) if email else None
+		return email
+
 	def avatar(self, size):
-		digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-		return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+		return avatar_url(self.avatar_digest or avatar_digest(self.email), size)
 
 	def get_reset_password_token(self, expires_in=900):
 		return jwt.encode({'reset_password': self.id, 'exp': time() + expires_in}, current_app.config['SECRET_KEY'], algorithm='HS256')
@@ -172,23 +276,25 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 			return
 		return db.session.get(User, id)
 
-	def unread_message_count(self):
-		last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-		query = sa.select(Message).where(Message.recipient == self,
-                                         Message.timestamp > last_read_time)
-		return db.session.scalar(sa.select(sa.func.count()).select_from(
-            query.subquery()))
+	def get_last_seen(self, buffered_seen=None):
+		# buffered_seen is buffered_last_seen_many() for a page of users
+		buffered = buffered_last_seen(self.id) if buffered_seen is None \
+			else buffered_seen.get(self.id)
+		if self.last_seen is None:
+			return buffered
+		last_seen = self.last_seen.replace(tzinfo=timezone.utc)
+		return max(last_seen, buffered) if buffered else last_seen
 
 	def add_notification(self, name, data):
-		db.session.execute(self.notifications.delete().where(
-            Notification.name == name))
-		n = Notification(name=name, payload_json=json.dumps(data), user=self)
-		db.session.add(n)
-		return n
+		return Notification.upsert(self.id, name, data)
 
 	def launch_task(self, name, description, *args, **kwargs):
+		# however the job ends, the worker marks its task complete
+		done = rq.Callback('app.tasks.mark_task_complete')
 		rq_job = current_app.task_queue.enqueue(f'app.tasks.{name}', self.id,
-                                                *args, **kwargs)
+                                                *args, on_success=done,
+                                                on_failure=done,
+                                                on_stopped=done, **kwargs)
 		task = Task(id=rq_job.get_id(), name=name, description=description,
                     user=self)
 		db.session.add(task)
@@ -198,24 +304,40 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 		query = self.tasks.select().where(Task.complete == False)
 		return db.session.scalars(query)
 
-	def get_task_in_progress(self, name):
+	def get_task_progress(self):
+		"""Return (task, progress) for tasks in progress, leaving out the
+		ones whose job turns out to be done."""
+		tasks = self.get_tasks_in_progress().all()
+		progress = Task.get_progress_many(tasks)
+		return [(task, progress[task.id]) for task in tasks
+			if progress[task.id] < 100]
+
+	def get_task_in_progress(self, name, mark_complete=False):
 		query = self.tasks.select().where(Task.name == name,
 			Task.complete == False)
-		return db.session.scalar(query)
-
-	def companions_count(self):
-		query = sa.select(sa.func.count()).select_from(
-			self.companions.select().subquery())
-		return db.session.scalar(query)
-
-	def to_dict(self, include_email=False):
+		tasks = db.session.scalars(query).all()
+		# a job that died without its callback doesn't block a new one;
+		# with mark_complete its task is also marked complete
+		progress = Task.get_progress_many(tasks)
+		if mark_complete:
+			Task.mark_complete([task.id for task in tasks
+				if progress[task.id] >= 100])
+		return next((task for task in tasks if progress[task.id] < 100), None)
+
+	@classmethod
+	def to_dicts(cls, users):
+		# one HMGET for the page instead of an HGET per user
+		users = list(users)
+		buffered_seen = buffered_last_seen_many([user.id for user in users])
+		return [user.to_dict(buffered_seen=buffered_seen) for user in users]
+
+	def to_dict(self, include_email=False, buffered_seen=None):
 		data = {
 			'id': self.id,
 			'username': self.username,
-			'last_seen': self.last_seen.replace(
-				tzinfo=timezone.utc).isoformat(),
+			'last_seen': self.get_last_seen(buffered_seen).isoformat(),
 			'about_me': self.about_me,
-			'companion_count': self.companions_count(),
+			'companion_count': self.companion_count,
 			'_links': {
 				'self': url_for('api.get_user', id=self.id),
 				'companions': url_for('api.get_companions', id=self.id),
@@ -249,17 +371,94 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
 	@staticmethod
 	def check_token(token):
-		user = db.session.scalar(sa.select(User).where(User.token == token))
-		if user is None or user.token_expiration.replace(
-				tzinfo=timezone.utc) < datetime.now(timezone.utc):
+		cached = token_cache.get(token)
+		if cached is not None:
+			user = restore(User, cached)
+		else:
+			user = db.session.scalar(sa.select(User).where(User.token == token))
+		if user is None:
+			return None
+		remaining = user.token_expiration.replace(
+			tzinfo=timezone.utc) - datetime.now(timezone.utc)
+		if remaining.total_seconds() < 0:
 			return None
+		if cached is None and not reads_from_replica(db.session):
+			token_cache.set(token, snapshot(user, TOKEN_SNAPSHOT_EXCLUDE),
+				min(current_app.config['TOKEN_CACHE_TTL'],
+					remaining.total_seconds()))
+		return user
+
+	@staticmethod
+	def get_cached(id):
+		version, cached = user_cache.get_many(f'v:{id}', f'id:{id}')
+		version = version or 0
+		if cached is not None and cached['v'] == version:
+			user_cache.record(True)
+			return restore(User, cached['user'])
+		user_cache.record(False)
+		user = db.session.get(User, id)
+		# a lagging replica's row would be stored under the current version
+		# and outlive the lag
+		if user is not None and not reads_from_replica(db.session):
+			user_cache.set(f'id:{id}', {'v': version, 'user': snapshot(
+				user, USER_SNAPSHOT_EXCLUDE)},
+				current_app.config['USER_CACHE_TTL'])
+		return user
+
+	@staticmethod
+	def get_by_username(username):
+		user_id = user_cache.get('name:' + username)
+		if user_id is not None:
+			user = User.get_cached(user_id)
+			# a rename or delete may have raced the lookup
+			if user is not None and user.username == username:
+				return user
+		user = db.session.scalar(sa.select(User).where(
+			User.username == username))
+		if user is not None and not reads_from_replica(db.session):
+			user_cache.set('name:' + username, user.id,
+				current_app.config['USER_CACHE_TTL'])
 		return user
 
+def _collect_stale_entries(mapper, connection, target):
+	state = sa.inspect(target)
+	tokens = set(state.attrs.token.history.sum())
+	tokens.discard(None)
+	usernames = set(state.attrs.username.history.sum())
+	usernames.discard(None)
+	session = so.object_session(target)
+	session.info.setdefault('stale_tokens', set()).update(tokens)
+	session.info.setdefault('stale_usernames', set()).update(usernames)
+	session.info.setdefault('stale_users', set()).add(target.id)
+
+def _invalidate_stale_entries(session):
+	tokens = session.info.pop('stale_tokens', None)
+	if tokens:
+		token_cache.delete(*tokens)
+	user_ids = session.info.pop('stale_users', None)
+	usernames = session.info.pop('stale_usernames', ())
+	if user_ids:
+		invalidate_cached_users(user_ids, usernames)
+
+def invalidate_cached_users(user_ids, usernames=()):
+	# deleting covers the common case; bumping the version also rejects a
+	# snapshot that a concurrent request read before the change committed
+	# and stores after this runs
+	user_cache.delete(*[f'id:{id}' for id in user_ids],
+		*[f'name:{name}' for name in usernames])
+	user_cache.incr(*[f'v:{id}' for id in user_ids])
+
+# any change to a User (revoke_token, get_token rotation, profile edits,
+# deletes) drops its cached entries once the change is committed
+db.event.listen(User, 'after_update', _collect_stale_entries)
+db.event.listen(User, 'after_delete', _collect_stale_entries)
+db.event.listen(db.session, 'after_commit', _invalidate_stale_entries)
+
 @login.user_loader
 def load_user(id):
-	return db.session.get(User, int(id))
+	return User.get_cached(int(id))
 
-class Companion(db.Model):
+class Companion(PaginatedAPIMixin, db.Model):
 	#need to add many more of these companion details later!
 	#probably need a full list of all of their details as mentioned in the ipynb
 	id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -275,8 +474,28 @@ class Companion(db.Model):
 	def __repr__(self):
 		return '<Companion: {}>'.format(self.companion_name)
 
+	def to_dict(self):
+		return {
+			'id': self.id,
+			'companion_name': self.companion_name,
+			'gender': self.gender,
+			'realism': self.realism,
+			'created_at': self.created_at_ts.replace(
+				tzinfo=timezone.utc).isoformat(),
+			'_links': {
+				'creator': url_for('api.get_user', id=self.associated_user_id)
+			}
+		}
+
 class Message(SearchableMixin, db.Model):
 	__searchable__ = ['body']
+	__search_profile__ = 'message_list'
+	# an inbox is read by recipient in timestamp order and its unread count
+	# is a timestamp range per recipient
+	__table_args__ = (
+		sa.Index('ix_message_recipient_id_timestamp', 'recipient_id',
+			'timestamp'),
+	)
 	id: so.Mapped[int] = so.mapped_column(primary_key=True)
 	body: so.Mapped[str] = so.mapped_column(sa.String(140))
 	timestamp: so.Mapped[datetime] = so.mapped_column(
@@ -284,7 +503,7 @@ class Message(SearchableMixin, db.Model):
 	sender_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, onupdate='CASCADE', ondelete='CASCADE'),
                                                nullable=False, index=True)
 	recipient_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, onupdate='CASCADE', ondelete='CASCADE'),
-                                               nullable=False, index=True)
+                                               nullable=False)
 	language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
 
 	
@@ -299,10 +518,18 @@ class Message(SearchableMixin, db.Model):
 		return '<Message {}>'.format(self.body)
 
 class Notification(db.Model):
+	# a user has one notification per name, which upserts conflict on; the
+	# polling view and the event stream backlog read a user's notifications
+	# since a timestamp
+	__table_args__ = (
+		sa.Index('ix_notification_user_id_name', 'user_id', 'name',
+			unique=True),
+		sa.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),
+	)
 	id: so.Mapped[int] = so.mapped_column(primary_key=True)
 	name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
 	user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, onupdate='CASCADE', ondelete='CASCADE'),
-	                                           nullable=False, index=True)
+	                                           nullable=False)
 	timestamp: so.Mapped[float] = so.mapped_column(index=True, default=time)
 	payload_json: so.Mapped[str] = so.mapped_column(sa.Text)
 
@@ -312,7 +539,166 @@ class Notification(db.Model):
 	def get_data(self):
 		return json.loads(str(self.payload_json))
 
+	@staticmethod
+	def upsert(user_id, name, data, session=None):
+		# one INSERT ... ON CONFLICT / ON DUPLICATE KEY UPDATE against the
+		# unique (user_id, name) index; other databases UPDATE and INSERT
+		# only when nothing was updated
+		session = session or db.session
+		now = time()
+		values = {'payload_json': json.dumps(data), 'timestamp': now}
+		dialect = db.engine.dialect.name
+		if dialect == 'mysql':
+			stmt = mysql.insert(Notification).values(
+				user_id=user_id, name=name, **values)
+			session.execute(stmt.on_duplicate_key_update(**values))
+		elif dialect in ('sqlite', 'postgresql'):
+			insert = sqlite.insert if dialect == 'sqlite' \
+				else postgresql.insert
+			stmt = insert(Notification).values(
+				user_id=user_id, name=name, **values)
+			session.execute(stmt.on_conflict_do_update(
+				index_elements=['user_id', 'name'], set_=values))
+		else:
+			result = session.execute(sa.update(Notification).where(
+				Notification.user_id == user_id,
+				Notification.name == name).values(**values),
+				execution_options={'synchronize_session': False})
+			if result.rowcount == 0:
+				session.execute(sa.insert(Notification).values(
+					user_id=user_id, name=name, **values))
+		# published to the user's channel once the transaction commits
+		session.info.setdefault('notifications', []).append(
+			(user_id, {'name': name, 'data': data, 'timestamp': now}))
+		return now
+
+	@staticmethod
+	def prune(before, chunk_size=1000, pause=0, report=None):
+		"""Delete notifications last updated before the before timestamp,
+		chunk_size rows per transaction with pause seconds between chunks,
+		so no lock is held for long. report(rows, seconds) is called after
+		each chunk. Returns the number of rows deleted."""
+		deleted = 0
+		while True:
+			started = monotonic()
+			ids = db.session.scalars(sa.select(Notification.id).where(
+				Notification.timestamp < before).order_by(
+				Notification.timestamp).limit(chunk_size)).all()
+			if ids:
+				db.session.execute(sa.delete(Notification).where(
+					Notification.id.in_(ids)),
+					execution_options={'synchronize_session': False})
+			db.session.commit()
+			deleted += len(ids)
+			if report and ids:
+				report(len(ids), monotonic() - started)
+			if len(ids) < chunk_size:
+				return deleted
+			if pause:
+				sleep(pause)
+
+class SearchOutbox(db.Model):
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    index: so.Mapped[str] = so.mapped_column(sa.String(64))
+    object_id: so.Mapped[int]
+    op: so.Mapped[str] = so.mapped_column(sa.String(8))
+    created_at: so.Mapped[float] = so.mapped_column(default=time)
+    attempts: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    next_attempt_at: so.Mapped[float] = so.mapped_column(
+        index=True, default=0, server_default='0')
+    # set once an entry has failed SEARCH_OUTBOX_MAX_ATTEMPTS times; parked
+    # entries are left for an operator (`flask search unpark`)
+    parked: so.Mapped[bool] = so.mapped_column(default=False,
+                                               server_default='0')
+
+    @classmethod
+    def drain(cls, batch_size):
+        """Ship up to batch_size due entries to Elasticsearch in one bulk
+        request. Returns the number of entries processed."""
+        now = time()
+        entries = db.session.scalars(sa.select(cls).where(
+            cls.parked == False, cls.next_attempt_at <= now).order_by(
+            cls.id).limit(batch_size)).all()
+        if not entries:
+            return 0
+        # entries come in id order, so the newest operation per document
+        # wins; documents are indexed from their current row, which makes
+        # replaying an entry harmless
+        latest = {(e.index, e.object_id): e.op for e in entries}
+        objects = {}
+        for index in {index for index, _ in latest}:
+            model = SearchableMixin.model_for(index)
+            ids = [id for (i, id), op in latest.items()
+                   if i == index and op == 'index']
+            for obj in db.session.scalars(
+                    sa.select(model).where(model.id.in_(ids))):
+                objects[(index, obj.id)] = obj
+        actions = [index_action(key[0], objects[key]) if key in objects
+                   else delete_action(*key) for key in latest]
+        failed = bulk_index(actions)
+
+        done = [e.id for e in entries if (e.index, e.object_id) not in failed]
+        if done:
+            db.session.execute(sa.delete(cls).where(cls.id.in_(done)))
+        retries = {}
+        for e in entries:
+            if (e.index, e.object_id) in failed:
+                retries.setdefault(e.attempts + 1, []).append(e.id)
+        max_backoff = current_app.config['SEARCH_OUTBOX_MAX_BACKOFF']
+        max_attempts = current_app.config['SEARCH_OUTBOX_MAX_ATTEMPTS']
+        for attempts, ids in retries.items():
+            if attempts >= max_attempts:
+                current_app.logger.warning(
+                    'Parking {0} search outbox entries after {1} failed '
+                    'attempts'.format(len(ids), attempts))
+                values = {'attempts': attempts, 'parked': True}
+            else:
+                values = {'attempts': attempts, 'next_attempt_at':
+                          now + min(2 ** attempts, max_backoff)}
+            db.session.execute(sa.update(cls).where(cls.id.in_(ids)).values(
+                values))
+        db.session.commit()
+        return len(entries)
+
+    @classmethod
+    def lag(cls):
+        """Return (pending entries, seconds since the oldest was written),
+        leaving out parked entries."""
+        pending, oldest = db.session.execute(sa.select(
+            sa.func.count(cls.id), sa.func.min(cls.created_at)).where(
+            cls.parked == False)).one()
+        return pending, time() - oldest if oldest else 0.0
+
+    @classmethod
+    def parked_count(cls):
+        return db.session.scalar(sa.select(sa.func.count(cls.id)).where(
+            cls.parked == True))
+
+    @classmethod
+    def unpark(cls):
+        """Give every parked entry a fresh set of attempts, due now. Returns
+        how many there were."""
+        result = db.session.execute(sa.update(cls).where(
+            cls.parked == True).values(parked=False, attempts=0,
+                                       next_attempt_at=0))
+        db.session.commit()
+        return result.rowcount
+
+    @classmethod
+    def next_retry_at(cls):
+        return db.session.scalar(sa.select(sa.func.min(
+            cls.next_attempt_at)).where(cls.parked == False))
+
+TASK_DONE = (rq.job.JobStatus.FINISHED, rq.job.JobStatus.FAILED,
+             rq.job.JobStatus.STOPPED, rq.job.JobStatus.CANCELED)
+
 class Task(db.Model):
+    # every page lists the user's unfinished tasks, and launching one checks
+    # for an unfinished task of the same name
+    __table_args__ = (
+        sa.Index('ix_task_user_id_name_complete', 'user_id', 'name',
+                 'complete'),
+    )
     id: so.Mapped[str] = so.mapped_column(sa.String(36), primary_key=True)
     name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
     description: so.Mapped[Optional[str]] = so.mapped_column(sa.String(128))
@@ -331,4 +717,174 @@ class Task(db.Model):
 
     def get_progress(self):
         job = self.get_rq_job()
-        return job.meta.get('progress', 0) if job is not None else 100
\ No newline at end of file
+        return job.meta.get('progress', 0) if job is not None else 100
+
+    @staticmethod
+    def get_progress_many(tasks):
+        """Return {task id: progress} for tasks, fetching all their RQ jobs in
+        one pipelined round trip. Tasks whose job has finished, failed or
+        expired count as 100; marking them complete is left to the worker
+        (see launch_task), so this is safe to call on any read path."""
+        ids = [task.id for task in tasks]
+        if not ids:
+            return {}
+        try:
+            jobs = rq.job.Job.fetch_many(ids, connection=current_app.redis)
+        except redis.exceptions.RedisError:
+            # without Redis nothing is known; leave the tasks as they are
+            return {id: 0 for id in ids}
+        progress = {}
+        for id, job in zip(ids, jobs):
+            if job is None or job.get_status(refresh=False) in TASK_DONE:
+                progress[id] = 100
+            else:
+                progress[id] = job.meta.get('progress', 0)
+        return progress
+
+    @staticmethod
+    def mark_complete(ids):
+        if ids:
+            db.session.execute(sa.update(Task).where(Task.id.in_(ids)).values(
+                complete=True))
+
+    @staticmethod
+    def complete_finished(batch_size=500):
+        """Mark every unfinished task whose job finished, failed or expired
+        complete, batch_size tasks per Redis round trip and UPDATE, and
+        return how many there were. These are the jobs that ended without
+        their callback, such as ones whose worker was killed."""
+        completed = 0
+        last_id = ''
+        while True:
+            tasks = db.session.execute(
+                sa.select(Task.id).where(Task.complete == False,
+                                         Task.id > last_id)
+                .order_by(Task.id).limit(batch_size)).all()
+            if not tasks:
+                return completed
+            progress = Task.get_progress_many(tasks)
+            done = [id for id, value in progress.items() if value >= 100]
+            Task.mark_complete(done)
+            db.session.commit()
+            completed += len(done)
+            last_id = tasks[-1].id
+
+
+# loader options for the relationships a view's template walks per row, so a
+# page costs one extra query instead of one per row
+LOADER_PROFILES = {
+    # _post.html shows each message's author
+    'message_list': (so.selectinload(Message.author),),
+    # index.html shows each companion's creator
+    'companion_list': (so.selectinload(Companion.creator),),
+}
+
+def loader_options(profile):
+    """Options for the named loader profile. With RAISE_ON_LAZY_LOAD set,
+    any other relationship of the loaded rows raises when accessed instead
+    of quietly issuing a query."""
+    options = list(LOADER_PROFILES[profile])
+    if current_app.config['RAISE_ON_LAZY_LOAD']:
+        options.append(so.raiseload('*'))
+    return options
+
+
+def _unread_messages_subquery(last_read_time):
+    return sa.select(sa.func.count(Message.id)).where(
+        Message.recipient_id == User.id,
+        Message.timestamp > sa.func.coalesce(
+            last_read_time, datetime(1900, 1, 1))).scalar_subquery()
+
+
+def _bump_counter(target, connection, user_id, column, delta, *criteria):
+    # a single atomic UPDATE ... SET x = x + delta inside the flush; the
+    # in-memory User is expired afterwards so the next read sees the new value
+    connection.execute(sa.update(User).where(User.id == user_id, *criteria)
+                       .values({column: getattr(User, column) + delta}))
+    session = so.object_session(target)
+    session.info.setdefault('counter_users', set()).add(user_id)
+    session.info.setdefault('stale_users', set()).add(user_id)
+
+
+@sa.event.listens_for(Companion, 'after_insert')
+def _companion_inserted(mapper, connection, target):
+    _bump_counter(target, connection, target.associated_user_id,
+                  'companion_count', 1)
+
+
+@sa.event.listens_for(Companion, 'after_delete')
+def _companion_deleted(mapper, connection, target):
+    _bump_counter(target, connection, target.associated_user_id,
+                  'companion_count', -1, User.companion_count > 0)
+
+
+def _is_unread(timestamp):
+    return sa.or_(User.last_message_read_time.is_(None),
+                  User.last_message_read_time < timestamp)
+
+
+@sa.event.listens_for(Message, 'after_insert')
+def _message_inserted(mapper, connection, target):
+    _bump_counter(target, connection, target.recipient_id,
+                  'unread_message_count', 1, _is_unread(target.timestamp))
+    if target.language is None:
+        so.object_session(target).info.setdefault(
+            'detect_languages', []).append(target.id)
+
+
+@sa.event.listens_for(Message, 'after_delete')
+def _message_deleted(mapper, connection, target):
+    _bump_counter(target, connection, target.recipient_id,
+                  'unread_message_count', -1, _is_unread(target.timestamp),
+                  User.unread_message_count > 0)
+
+
+def _recount_unread_on_read(session, flush_context, instances):
+    for obj in session.dirty:
+        if isinstance(obj, User) and sa.inspect(obj).attrs \
+                .last_message_read_time.history.has_changes():
+            obj.unread_message_count = _unread_messages_subquery(
+                obj.last_message_read_time)
+
+
+def _expire_bumped_counters(session, flush_context):
+    for user_id in session.info.pop('counter_users', ()):
+        user = session.identity_map.get(so.util.identity_key(User, user_id))
+        if user is not None:
+            session.expire(user, ['companion_count', 'unread_message_count'])
+
+def _detect_new_languages(session):
+    # new messages get their language from a background job, not inline
+    ids = session.info.pop('detect_languages', None)
+    if ids:
+        schedule_language_detection(ids)
+
+
+def _discard_new_languages(session):
+    session.info.pop('detect_languages', None)
+
+db.event.listen(db.session, 'before_flush', _recount_unread_on_read)
+db.event.listen(db.session, 'after_flush_postexec', _expire_bumped_counters)
+db.event.listen(db.session, 'after_commit', _detect_new_languages)
+db.event.listen(db.session, 'after_rollback', _discard_new_languages)
+
+
+def reconcile_counters(batch_size=1000):
+    """Recompute User.companion_count and User.unread_message_count from the
+    source tables, batch_size users per transaction. Returns rows repaired."""
+    companions = sa.select(sa.func.count(Companion.id)).where(
+        Companion.associated_user_id == User.id).scalar_subquery()
+    unread = _unread_messages_subquery(User.last_message_read_time)
+    repaired = 0
+    last_id = db.session.scalar(sa.select(sa.func.max(User.id))) or 0
+    for start in range(0, last_id, batch_size):
+        result = db.session.execute(
+            sa.update(User).where(
+                User.id > start, User.id <= start + batch_size,
+                sa.or_(User.companion_count != companions,
+                       User.unread_message_count != unread)).values(
+                companion_count=companions, unread_message_count=unread),
+            execution_options={'synchronize_session': False})
+        db.session.commit()
+        repaired += result.rowcount
+    return repaired
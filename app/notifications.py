@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+import redis
+from flask import current_app
+
+
+def notification_channel(user_id):
+    return f'notifications:{user_id}'
+
+
+def publish_notification(user_id, payload):
+    try:
+        current_app.redis.publish(notification_channel(user_id),
+                                  json.dumps(payload))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(
+            'Could not publish notification for user {0}'.format(user_id))
+
+
+def publish_pending_notifications(session):
+    for user_id, payload in session.info.pop('notifications', []):
+        publish_notification(user_id, payload)
+
+
+def discard_pending_notifications(session):
+    session.info.pop('notifications', None)
+
+
+_stream_lock = threading.Lock()
+_open_streams = 0
+
+
+def open_stream_slot(limit):
+    """Claim one of limit event stream slots in this process. Each open
+    stream pins a worker thread for up to NOTIFICATION_STREAM_TIMEOUT, so
+    past the limit the client is turned away and falls back to polling,
+    leaving the other threads for page requests. Returns False when all
+    slots are taken."""
+    global _open_streams
+    with _stream_lock:
+        if _open_streams >= limit:
+            return False
+        _open_streams += 1
+        return True
+
+
+def close_stream_slot():
+    global _open_streams
+    with _stream_lock:
+        _open_streams -= 1
+
+
+def format_event(payload):
+    # the timestamp doubles as the event id, so a reconnecting EventSource
+    # sends it back as Last-Event-ID and resumes where it left off
+    return 'id: {0}\ndata: {1}\n\n'.format(payload['timestamp'],
+                                            json.dumps(payload))
+
+
+def notification_events(pubsub, backlog, since, timeout, keepalive=15):
+    """Yield SSE frames: first the backlog newer than since, then anything
+    published on the subscribed channel until timeout seconds pass."""
+    try:
+        yield 'retry: 2000\n\n'
+        for payload in backlog:
+            since = max(since, payload['timestamp'])
+            yield format_event(payload)
+        deadline = time.monotonic() + timeout
+        last_sent = time.monotonic()
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=1.0)
+            if message is None or message['type'] != 'message':
+                if time.monotonic() - last_sent >= keepalive:
+                    last_sent = time.monotonic()
+                    yield ': keepalive\n\n'
+                continue
+            payload = json.loads(message['data'])
+            if payload['timestamp'] <= since:
+                continue
+            since = payload['timestamp']
+            last_sent = time.monotonic()
+            yield format_event(payload)
+    finally:
+        pubsub.close()
@@ -0,0 +1,127 @@
+import base64
+import binascii
+from collections import namedtuple
+from datetime import datetime
+import json
+import threading
+import time
+import redis
+import sqlalchemy as sa
+from flask import abort, current_app
+from app import db
+
+KeysetPage = namedtuple('KeysetPage', ['items', 'next_cursor', 'prev_cursor'])
+
+_counts = {}
+_counts_lock = threading.Lock()
+
+
+def encode_cursor(values, direction):
+    payload = [direction] + [v.isoformat() if isinstance(v, datetime) else v
+                             for v in values]
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, *values = json.loads(raw)
+        if direction not in ('next', 'prev') or len(values) != len(columns):
+            raise ValueError(cursor)
+        values = [datetime.fromisoformat(v)
+                  if isinstance(column.type, sa.DateTime) else v
+                  for column, v in zip(columns, values)]
+    except (ValueError, TypeError, binascii.Error):
+        abort(400)
+    return direction, values
+
+
+def _beyond(columns, values, descending):
+    # (a, b) > (x, y) spelled out as a < x OR (a = x AND b < y), which both
+    # SQLite and MySQL can satisfy with a range scan on the leading column
+    clauses = []
+    for i, column in enumerate(columns):
+        prefix = [c == v for c, v in zip(columns[:i], values[:i])]
+        step = column < values[i] if descending else column > values[i]
+        clauses.append(sa.and_(*prefix, step))
+    return sa.or_(*clauses)
+
+
+def keyset_paginate(query, columns, cursor=None, per_page=20,
+                    descending=False):
+    """Return one page of query ordered by columns, starting after (or, for a
+    "prev" cursor, ending before) the row the cursor points at."""
+    direction, values = decode_cursor(cursor, columns) if cursor \
+        else ('next', None)
+    backwards = direction == 'prev'
+    reverse = descending != backwards
+    if values is not None:
+        query = query.where(_beyond(columns, values, reverse))
+    query = query.order_by(*[c.desc() if reverse else c.asc()
+                             for c in columns]).limit(per_page + 1)
+    items = db.session.scalars(query).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+    has_next = has_more if not backwards else True
+    has_prev = has_more if backwards else values is not None
+    next_cursor = prev_cursor = None
+    if items and has_next:
+        next_cursor = encode_cursor(
+            [getattr(items[-1], c.key) for c in columns], 'next')
+    if items and has_prev:
+        prev_cursor = encode_cursor(
+            [getattr(items[0], c.key) for c in columns], 'prev')
+    return KeysetPage(items, next_cursor, prev_cursor)
+
+
+def keyset_batches(query, columns, batch_size):
+    """Yield the rows of query in order of columns, batch_size rows per
+    SELECT, each one resuming after the last row of the one before. No
+    cursor stays open between batches, so the caller may commit while it
+    iterates. columns must be selected by query and unique together."""
+    values = None
+    while True:
+        page = query if values is None else \
+            query.where(_beyond(columns, values, False))
+        rows = db.session.execute(
+            page.order_by(*columns).limit(batch_size)).all()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        values = [getattr(rows[-1], column.key) for column in columns]
+
+
+def offset_paginate(query, page, per_page):
+    """OFFSET pagination without the COUNT(*): fetches one extra row to tell
+    whether a next page exists. Returns (items, has_next)."""
+    page = max(page, 1)
+    items = db.session.scalars(
+        query.limit(per_page + 1).offset((page - 1) * per_page)).all()
+    return items[:per_page], len(items) > per_page
+
+
+def cached_count(key, query):
+    """Return COUNT(*) of query, recomputed at most once every
+    PAGINATION_COUNT_TTL seconds per key."""
+    key = 'count:' + key
+    ttl = current_app.config['PAGINATION_COUNT_TTL']
+    try:
+        total = current_app.redis.get(key)
+        if total is not None:
+            return int(total)
+    except redis.exceptions.RedisError:
+        with _counts_lock:
+            expires, total = _counts.get(key, (0, None))
+        if expires > time.monotonic():
+            return total
+    total = db.session.scalar(
+        sa.select(sa.func.count()).select_from(query.subquery()))
+    try:
+        current_app.redis.set(key, total, ex=ttl)
+    except redis.exceptions.RedisError:
+        with _counts_lock:
+            _counts[key] = (time.monotonic() + ttl, total)
+    return total
@@ -0,0 +1,163 @@
+import atexit
+from datetime import datetime, timezone
+import threading
+import time
+import redis
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+
+# write-behind buffer for User.last_seen. Requests record "seen at" here (Redis
+# when it is reachable, otherwise this process) and a flusher thread writes
+# everything out with one bulk UPDATE per PRESENCE_FLUSH_INTERVAL seconds.
+REDIS_KEY = 'presence:last_seen'
+
+_lock = threading.Lock()
+_buffer = {}
+_recorded = {}
+_flusher = None
+
+
+def _as_timestamp(dt):
+    if dt is None:
+        return 0.0
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+def record_last_seen(user, now=None):
+    """Buffer a "seen at" for user, skipping it if the last known value is
+    fresher than PRESENCE_STALENESS seconds. Returns True if recorded."""
+    now = now or time.time()
+    staleness = current_app.config['PRESENCE_STALENESS']
+    with _lock:
+        known = max(_recorded.get(user.id, 0.0), _as_timestamp(user.last_seen))
+        if now - known < staleness:
+            return False
+        _recorded[user.id] = now
+    try:
+        current_app.redis.hset(REDIS_KEY, user.id, now)
+    except redis.exceptions.RedisError:
+        with _lock:
+            _buffer[user.id] = max(_buffer.get(user.id, 0.0), now)
+    _ensure_flusher(current_app._get_current_object())
+    return True
+
+
+def buffered_last_seen(user_id):
+    """Return the newest buffered "seen at" for user_id that has not been
+    flushed yet, or None."""
+    return buffered_last_seen_many([user_id]).get(user_id)
+
+
+def buffered_last_seen_many(user_ids):
+    """buffered_last_seen for several users with a single HMGET. Returns
+    {user_id: datetime}, leaving out users with nothing buffered."""
+    if not user_ids:
+        return {}
+    with _lock:
+        pending = {user_id: _buffer[user_id] for user_id in user_ids
+                   if user_id in _buffer}
+    try:
+        values = current_app.redis.hmget(REDIS_KEY, user_ids)
+    except redis.exceptions.RedisError:
+        values = [None] * len(user_ids)
+    for user_id, value in zip(user_ids, values):
+        if value is not None:
+            pending[user_id] = max(pending.get(user_id, 0.0), float(value))
+    return {user_id: datetime.fromtimestamp(ts, timezone.utc)
+            for user_id, ts in pending.items()}
+
+
+def _drain():
+    with _lock:
+        pending = dict(_buffer)
+        _buffer.clear()
+        cutoff = time.time() - current_app.config['PRESENCE_STALENESS']
+        for user_id in [k for k, v in _recorded.items() if v < cutoff]:
+            del _recorded[user_id]
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.hgetall(REDIS_KEY)
+        pipe.delete(REDIS_KEY)
+        stored, _ = pipe.execute()
+    except redis.exceptions.RedisError:
+        stored = {}
+    for user_id, ts in stored.items():
+        user_id, ts = int(user_id), float(ts)
+        pending[user_id] = max(pending.get(user_id, 0.0), ts)
+    return pending
+
+
+def _restore(pending):
+    # put back a batch that could not be written, without overwriting
+    # anything recorded since it was drained
+    try:
+        pipe = current_app.redis.pipeline()
+        for user_id, ts in pending.items():
+            pipe.hsetnx(REDIS_KEY, user_id, ts)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        with _lock:
+            for user_id, ts in pending.items():
+                _buffer[user_id] = max(_buffer.get(user_id, 0.0), ts)
+
+
+def flush_last_seen():
+    """Write all buffered "seen at" values with a single UPDATE. Returns the
+    number of users in the batch. If the write fails the batch is buffered
+    again for the next flush."""
+    from app.models import User, invalidate_cached_users
+    pending = _drain()
+    if not pending:
+        return 0
+    seen_at = sa.case(
+        {user_id: datetime.fromtimestamp(ts, timezone.utc)
+         for user_id, ts in pending.items()},
+        value=User.id)
+    try:
+        # never move last_seen backwards if another worker flushed a newer
+        # value
+        db.session.execute(
+            sa.update(User).where(User.id.in_(pending.keys()), sa.or_(
+                User.last_seen.is_(None), User.last_seen < seen_at)).values(
+                last_seen=seen_at),
+            execution_options={'synchronize_session': False})
+        db.session.commit()
+    except Exception:
+        _restore(pending)
+        raise
+    invalidate_cached_users(pending.keys())
+    return len(pending)
+
+
+class _Flusher(threading.Thread):
+    def __init__(self, app):
+        super().__init__(name='presence-flusher', daemon=True)
+        self.app = app
+        self.interval = app.config['PRESENCE_FLUSH_INTERVAL']
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self.app.app_context():
+            try:
+                flush_last_seen()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception('Presence flush failed')
+            finally:
+                db.session.remove()
+
+
+def _ensure_flusher(app):
+    global _flusher
+    if _flusher is not None or not app.config['PRESENCE_FLUSH_INTERVAL']:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = _Flusher(app)
+            _flusher.start()
+            atexit.register(_flusher.flush)
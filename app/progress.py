@@ -0,0 +1,73 @@
+import time
+import sqlalchemy as sa
+from flask import current_app
+from rq import get_current_job
+from app import db
+from app.models import Notification, Task
+
+
+class ProgressReporter:
+    """Coalesces progress updates from an RQ task. Each write saves the job
+    meta and upserts the user's task_progress notification in a session of
+    its own, leaving the task's session alone, so
+    update() only writes when progress moved TASK_PROGRESS_STEP percent or
+    1 / TASK_PROGRESS_RATE seconds have passed since the last write. 100% is
+    always written, and leaving the with block writes it too.
+
+    The number of updates received and writes made is kept in the job meta
+    as progress_updates and progress_writes."""
+
+    def __init__(self, job=None, rate=None, step=None):
+        self.job = job or get_current_job()
+        self.rate = rate or current_app.config['TASK_PROGRESS_RATE']
+        self.step = step or current_app.config['TASK_PROGRESS_STEP']
+        self.progress = self.reported = None
+        self.reported_at = 0.0
+        self.updates = self.writes = 0
+        self._user_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finish()
+
+    def update(self, progress):
+        self.updates += 1
+        self.progress = progress
+        if self.reported is None or progress >= 100 or \
+                progress - self.reported >= self.step or \
+                time.monotonic() - self.reported_at >= 1 / self.rate:
+            self.flush()
+
+    def flush(self):
+        if self.job is None or self.progress is None or \
+                self.progress == self.reported:
+            return
+        progress = self.progress
+        self.writes += 1
+        self.job.meta.update(progress=progress,
+                             progress_updates=self.updates,
+                             progress_writes=self.writes)
+        self.job.save_meta()
+        # on a session of its own, so the task's unit of work is never
+        # committed or expired underneath it
+        with db.session.session_factory() as session:
+            if self._user_id is None:
+                self._user_id = session.scalar(sa.select(Task.user_id).where(
+                    Task.id == self.job.get_id()))
+            Notification.upsert(self._user_id, 'task_progress',
+                                {'task_id': self.job.get_id(),
+                                 'progress': progress}, session=session)
+            if progress >= 100:
+                session.execute(sa.update(Task).where(
+                    Task.id == self.job.get_id()).values(complete=True))
+            session.commit()
+        self.reported, self.reported_at = progress, time.monotonic()
+
+    def finish(self):
+        self.update(100)
+        current_app.logger.info(
+            'Progress for job {0}: {1} updates, {2} writes'.format(
+                self.job.get_id() if self.job else None, self.updates,
+                self.writes))
@@ -1,25 +1,346 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
 from flask import current_app
+import redis
+import sqlalchemy as sa
+from elasticsearch import ApiError, TransportError
+from elasticsearch.helpers import bulk
+from app import db
+from app.cache import Cache
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
+DRAIN_SCHEDULED_KEY = 'search:drain-scheduled'
+
+# (index, generation, query, page) -> id list and total. Every write to an
+# index bumps its generation, which orphans the entries built against the
+# old one; a copy keyed without the generation is kept for longer and is
+# served when the backend cannot be reached.
+result_cache = Cache('search:', maxsize=2048)
+
+
+class ElasticsearchBackend:
+    """Remote index. Writes are queued in the search outbox and shipped by
+    the RQ worker, so a slow cluster never stalls a request."""
+
+    uses_outbox = True
+
+    def __init__(self, client, logger):
+        self.client = client
+        self.logger = logger
+
+    def bulk(self, actions):
+        try:
+            _, errors = bulk(self.client, actions, raise_on_error=False,
+                             raise_on_exception=False)
+        except (ApiError, TransportError):
+            self.logger.exception('Bulk indexing request failed')
+            return {(a['_index'], int(a['_id'])) for a in actions}
+        failed = set()
+        for error in errors:
+            op, result = next(iter(error.items()))
+            if op == 'delete' and result.get('status') == 404:
+                continue
+            failed.add((result['_index'], int(result['_id'])))
+        return failed
+
+    def query(self, index, query, page, per_page):
+        search = self.client.search(
+            index=index,
+            query={'multi_match': {'query': query, 'fields': ['*']}},
+            from_=(page - 1) * per_page,
+            size=per_page)
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+
+class SQLiteSearchBackend:
+    """Embedded index in an SQLite FTS5 database next to the app, ranked
+    with BM25. Cheap enough to update in the committing request, and shared
+    by every worker on the node through the database file."""
+
+    uses_outbox = False
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._tables = set()
+
+    def _connection(self):
+        # one connection per process, opened lazily so forked workers don't
+        # share the parent's
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False,
+                                         isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._pid = os.getpid()
+            self._tables = {row[0] for row in self._conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        return self._conn
+
+    def _has_table(self, conn, index):
+        # another process may have created it since the connection opened
+        if index not in self._tables and conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = ?", (index,)).fetchone():
+            self._tables.add(index)
+        return index in self._tables
+
+    def _ensure_table(self, conn, index, fields):
+        if index not in self._tables:
+            columns = ', '.join(f'"{field}"' for field in fields)
+            conn.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS "{index}" '
+                         f'USING fts5({columns}, '
+                         f"tokenize='porter unicode61 remove_diacritics 2')")
+            self._tables.add(index)
+
+    def bulk(self, actions):
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN')
+            try:
+                for action in actions:
+                    index, id = action['_index'], int(action['_id'])
+                    if action.get('_op_type', 'index') == 'index':
+                        fields = list(action['_source'])
+                        self._ensure_table(conn, index, fields)
+                        conn.execute(f'DELETE FROM "{index}" WHERE rowid = ?',
+                                     (id,))
+                        conn.execute(
+                            f'INSERT INTO "{index}" (rowid, '
+                            + ', '.join(f'"{f}"' for f in fields)
+                            + ') VALUES (?' + ', ?' * len(fields) + ')',
+                            [id] + [action['_source'][f] for f in fields])
+                    elif self._has_table(conn, index):
+                        conn.execute(f'DELETE FROM "{index}" WHERE rowid = ?',
+                                     (id,))
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+        return set()
+
+    def query(self, index, query, page, per_page):
+        # match any of the words, like the multi_match query used with
+        # Elasticsearch; quoting keeps FTS5 operators in user input inert
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return [], 0
+        match = ' OR '.join('"{0}"'.format(term) for term in terms)
+        with self._lock:
+            conn = self._connection()
+            if not self._has_table(conn, index):
+                return [], 0
+            total = conn.execute(
+                f'SELECT count(*) FROM "{index}" WHERE "{index}" MATCH ?',
+                (match,)).fetchone()[0]
+            rows = conn.execute(
+                f'SELECT rowid FROM "{index}" WHERE "{index}" MATCH ? '
+                f'ORDER BY bm25("{index}") LIMIT ? OFFSET ?',
+                (match, per_page, (page - 1) * per_page)).fetchall()
+        return [row[0] for row in rows], total
+
+
+def create_search_backend(app):
+    if app.elasticsearch:
+        return ElasticsearchBackend(app.elasticsearch, app.logger)
+    if app.config['SEARCH_SQLITE_PATH']:
+        return SQLiteSearchBackend(app.config['SEARCH_SQLITE_PATH'])
+    return None
+
+def _document(model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, document=payload)
+    return payload
+
+def index_action(index, model):
+    return {'_op_type': 'index', '_index': index, '_id': model.id,
+            '_source': _document(model)}
+
+def delete_action(index, id):
+    return {'_op_type': 'delete', '_index': index, '_id': id}
+
+def bulk_index(actions):
+    """Apply actions in one bulk request. Returns the (index, id) pairs that
+    failed; deleting a document that is already gone is not a failure."""
+    if not current_app.search_backend:
+        return set()
+    failed = current_app.search_backend.bulk(actions)
+    bump_generation(*{action['_index'] for action in actions})
+    return failed
+
+def bump_generation(*indexes):
+    if indexes:
+        result_cache.incr(*[f'gen:{index}' for index in indexes])
+
+def add_to_index(index, model):
+    return bulk_index([index_action(index, model)])
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    return bulk_index([delete_action(index, model.id)])
+
+def schedule_outbox_drain():
+    # at most one drain job is queued at a time; the job clears the flag when
+    # it starts, so changes committed while it runs schedule the next one
+    try:
+        if current_app.redis.set(DRAIN_SCHEDULED_KEY, 1, nx=True, ex=60):
+            current_app.task_queue.enqueue('app.tasks.index_search_outbox')
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not schedule search outbox drain')
+
+def _load_checkpoint(key):
+    try:
+        raw = current_app.redis.get(key)
+    except redis.exceptions.RedisError:
+        return None
+    return json.loads(raw) if raw else None
+
+def _save_checkpoint(key, state):
+    try:
+        current_app.redis.set(key, json.dumps(state))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not save reindex checkpoint')
+
+def _shipped(future):
+    failed = future.result()
+    if failed:
+        raise RuntimeError(f'{len(failed)} documents failed to index')
+
+def _ship_rows(model, target, after_id, batch_size, workers, on_batch):
+    # rows are read as plain tuples in id order, yield_per rows at a time, so
+    # nothing lands in the identity map; bulk requests run on the pool and
+    # the checkpoint only moves past a batch once every batch before it is in
+    backend = current_app.search_backend
+    fields = model.__searchable__
+    query = sa.select(model.id, *[getattr(model, f) for f in fields]).where(
+        model.id > after_id).order_by(model.id).execution_options(
+        yield_per=batch_size)
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for rows in db.session.execute(query).partitions():
+            actions = [{'_index': target, '_id': row.id,
+                        '_source': {f: getattr(row, f) for f in fields}}
+                       for row in rows]
+            in_flight.append((rows[-1].id, len(rows),
+                              pool.submit(backend.bulk, actions)))
+            while in_flight and (len(in_flight) > workers * 2
+                                 or in_flight[0][2].done()):
+                last_id, count, future = in_flight.popleft()
+                _shipped(future)
+                on_batch(last_id, count)
+        while in_flight:
+            last_id, count, future = in_flight.popleft()
+            _shipped(future)
+            on_batch(last_id, count)
+
+def _swap_alias(alias, target):
+    es = current_app.elasticsearch
+    actions = [{'add': {'index': target, 'alias': alias}}]
+    old = []
+    if es.indices.exists_alias(name=alias):
+        old = [index for index in es.indices.get_alias(name=alias)
+               if index != target]
+        actions = [{'remove': {'index': index, 'alias': alias}}
+                   for index in old] + actions
+    elif es.indices.exists(index=alias):
+        # first rebuild after a plain index was used; the name must be freed
+        # before it can become an alias
+        es.indices.delete(index=alias)
+    es.indices.update_aliases(actions=actions)
+    for index in old:
+        es.indices.delete(index=index)
+
+def reindex(model, batch_size=500, workers=4, resume=False, swap=False,
+            report=None, report_every=5, after_id=0):
+    """Bulk index every row of model, or only those with ids above after_id.
+    With resume, continue from the last checkpoint. With swap, build a fresh
+    index and point the alias at it once it is complete. report(docs,
+    docs_per_second) is called every report_every seconds. Returns the
+    number of documents shipped.
+
+    Rows inserted while a swap build runs are copied once the alias has
+    moved; edits to rows that were already copied are not. Swapping needs
+    Elasticsearch aliases."""
+    if not current_app.search_backend:
+        return 0
+    if swap and not current_app.elasticsearch:
+        raise ValueError('swap needs the Elasticsearch backend')
+    alias = model.__tablename__
+    checkpoint_key = f'search:reindex:{alias}'
+    state = _load_checkpoint(checkpoint_key) if resume else None
+    if state is None:
+        target = f'{alias}-{int(time.time())}' if swap else alias
+        state = {'target': target, 'last_id': after_id, 'swap': swap}
+    if state['swap'] and not current_app.elasticsearch.indices.exists(
+            index=state['target']):
+        current_app.elasticsearch.indices.create(index=state['target'])
+
+    started = last_report = time.monotonic()
+    shipped = 0
+
+    def on_batch(last_id, count):
+        nonlocal shipped, last_report
+        shipped += count
+        state['last_id'] = last_id
+        _save_checkpoint(checkpoint_key, state)
+        now = time.monotonic()
+        if report and now - last_report >= report_every:
+            last_report = now
+            report(shipped, shipped / (now - started))
+
+    _ship_rows(model, state['target'], state['last_id'], batch_size, workers,
+               on_batch)
+    if state['swap']:
+        _swap_alias(alias, state['target'])
+        _ship_rows(model, state['target'], state['last_id'], batch_size,
+                   workers, on_batch)
+    try:
+        current_app.redis.delete(checkpoint_key)
+    except redis.exceptions.RedisError:
+        pass
+    bump_generation(alias)
+    if report:
+        report(shipped, shipped / max(time.monotonic() - started, 1e-6))
+    return shipped
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
+        return [], 0
+    return current_app.search_backend.query(index, query, page, per_page)
+
+def cached_query_index(index, query, page, per_page):
+    """query_index through the result cache. Returns (ids, total); if the
+    backend errors out, the last result seen for the query is returned
+    instead when there is one."""
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        query={'multi_match': {'query': query, 'fields': ['*']}},
-        from_=(page - 1) * per_page,
-        size=per_page)
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+    normalized = ' '.join(query.lower().split())
+    digest = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+    generation = result_cache.get_many(f'gen:{index}')[0] or 0
+    key = f'{index}:{page}:{per_page}:{digest}'
+    cached = result_cache.get(f'q:{generation}:{key}')
+    if cached is not None:
+        return cached['ids'], cached['total']
+    try:
+        ids, total = query_index(index, normalized, page, per_page)
+    except (ApiError, TransportError, sqlite3.Error):
+        stale = result_cache.get_many(f'stale:{key}')[0]
+        if stale is None:
+            raise
+        current_app.logger.warning('Search backend failed, serving stale '
+                                   'results for %s', index)
+        return stale['ids'], stale['total']
+    entry = {'ids': ids, 'total': total}
+    result_cache.set(f'q:{generation}:{key}', entry,
+                     current_app.config['SEARCH_CACHE_TTL'])
+    result_cache.set(f'stale:{key}', entry,
+                     current_app.config['SEARCH_STALE_TTL'])
+    return ids, total
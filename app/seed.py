@@ -0,0 +1,155 @@
+from datetime import datetime, timedelta, timezone
+import json
+import random
+import time
+import sqlalchemy as sa
+from werkzeug.security import generate_password_hash
+from app import db
+from app.avatars import avatar_digest
+from app.models import User, Companion, Message, Notification
+
+DISTRIBUTIONS = ('fixed', 'uniform', 'exponential', 'pareto')
+
+GENDERS = ('Female', 'Male', 'Other')
+REALISM = ('Realistic', 'Anime', 'Cartoon')
+WORDS = ('hello', 'weather', 'music', 'garden', 'travel', 'coffee', 'movie',
+         'book', 'dinner', 'weekend', 'work', 'sleep', 'game', 'walk', 'rain',
+         'sunny', 'tired', 'happy', 'tomorrow', 'today', 'friend', 'story')
+
+
+def sampler(distribution, mean, rng):
+    """Return a function drawing whole counts that average about mean.
+    uniform spreads them over 0..2*mean, exponential and pareto have long
+    tails; pareto gives a few users far more than everyone else, like a
+    real inbox, and is capped at 100 times the mean."""
+    if mean <= 0:
+        return lambda: 0
+    if distribution == 'fixed':
+        return lambda: int(mean)
+    if distribution == 'uniform':
+        return lambda: rng.randint(0, int(2 * mean))
+    if distribution == 'exponential':
+        return lambda: int(rng.expovariate(1 / mean) + 0.5)
+    if distribution == 'pareto':
+        # shape 2 has mean 2, so halve the scale
+        return lambda: min(int(mean / 2 * rng.paretovariate(2) + 0.5),
+                           int(100 * mean))
+    raise ValueError(f'unknown distribution {distribution}')
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Seeder:
+    """Bulk inserts synthetic users with their companions, received messages
+    and unread_message_count notifications. Rows go in as Core executemany
+    INSERTs of chunk_size rows, one transaction per chunk, so none of the
+    ORM flush hooks run: the denormalized counters are filled in from the
+    sampled counts, every user shares one password hash and the search
+    index is updated with a bulk reindex of the new messages at the end,
+    or not at all.
+
+    Ids are read back in insertion order, so nothing else should insert
+    users while a seed runs."""
+
+    def __init__(self, chunk_size=5000, password='password', days=365,
+                 seed=None, report=None, report_every=5):
+        self.chunk_size = chunk_size
+        self.password_hash = generate_password_hash(password)
+        self.days = days
+        self.rng = random.Random(seed)
+        self.report = report
+        self.report_every = report_every
+        self.rows = {}
+        self.seconds = {}
+
+    def insert(self, table, rows):
+        """executemany rows into table chunk_size at a time. Returns the
+        number of rows inserted."""
+        inserted = 0
+        started = last_report = time.perf_counter()
+        for chunk in _chunks(rows, self.chunk_size):
+            db.session.execute(sa.insert(table), chunk)
+            db.session.commit()
+            inserted += len(chunk)
+            now = time.perf_counter()
+            if self.report and now - last_report >= self.report_every:
+                last_report = now
+                self.report(table.name, inserted, inserted / (now - started))
+        self.rows[table.name] = self.rows.get(table.name, 0) + inserted
+        self.seconds[table.name] = self.seconds.get(table.name, 0.0) + \
+            time.perf_counter() - started
+        return inserted
+
+    def _timestamp(self, now):
+        return now - timedelta(seconds=self.rng.random() * self.days * 86400)
+
+    def run(self, users, messages=20, companions=2,
+            message_distribution='exponential',
+            companion_distribution='uniform', prefix='seed', index=True):
+        """Seed users users. messages and companions are the mean counts per
+        user for their distributions. Returns {table: rows inserted}."""
+        now = datetime.now(timezone.utc)
+        draw_messages = sampler(message_distribution, messages, self.rng)
+        draw_companions = sampler(companion_distribution, companions,
+                                  self.rng)
+        inbox = [draw_messages() for _ in range(users)]
+        owned = [draw_companions() for _ in range(users)]
+        last_user_id = db.session.scalar(sa.select(sa.func.max(User.id))) or 0
+        last_message_id = db.session.scalar(
+            sa.select(sa.func.max(Message.id))) or 0
+
+        first = last_user_id + 1
+        self.insert(User.__table__, ({
+            'username': f'{prefix}{first + i}',
+            'email': f'{prefix}{first + i}@example.com',
+            'avatar_digest': avatar_digest(f'{prefix}{first + i}@example.com'),
+            'password_hash': self.password_hash,
+            'about_me': ' '.join(self.rng.sample(WORDS, 5)),
+            'last_seen': self._timestamp(now),
+            'companion_count': owned[i],
+            'unread_message_count': inbox[i],
+        } for i in range(users)))
+        ids = db.session.scalars(sa.select(User.id).where(
+            User.id > last_user_id).order_by(User.id)).all()
+
+        self.insert(Companion.__table__, ({
+            'associated_user_id': user_id,
+            'companion_name': f'Companion {j + 1}',
+            'gender': self.rng.choice(GENDERS),
+            'realism': self.rng.choice(REALISM),
+            'created_at_ts': self._timestamp(now),
+        } for user_id, count in zip(ids, owned) for j in range(count)))
+
+        self.insert(Message.__table__, ({
+            'sender_id': self.rng.choice(ids),
+            'recipient_id': user_id,
+            'body': ' '.join(self.rng.choices(WORDS, k=self.rng.randint(3, 12))),
+            'timestamp': self._timestamp(now),
+        } for user_id, count in zip(ids, inbox) for _ in range(count)))
+
+        seeded_at = time.time()
+        self.insert(Notification.__table__, ({
+            'user_id': user_id,
+            'name': 'unread_message_count',
+            'payload_json': json.dumps(count),
+            'timestamp': seeded_at,
+        } for user_id, count in zip(ids, inbox)))
+
+        if index:
+            started = time.perf_counter()
+            self.rows['search'] = Message.reindex(
+                batch_size=self.chunk_size, after_id=last_message_id,
+                report_every=self.report_every,
+                report=(lambda docs, rate: self.report('search', docs, rate))
+                if self.report else None)
+            self.seconds['search'] = time.perf_counter() - started
+        return self.rows
@@ -1,81 +1,159 @@
+import os
 import time
 import sys
-import json
 import signal
 import sqlalchemy as sa
-from flask import render_template
-from rq import get_current_job
-from app import create_app, db
-from app.models import User, Companion, Task
+from flask import render_template, url_for
+from app import create_app, db, mail
+from app.models import User, Companion, Notification, SearchOutbox, Task
+from app.search import DRAIN_SCHEDULED_KEY
+from app.language import DETECT_SCHEDULED_KEY, detect_queued
 from app.email import send_email
+from app.exports import export_dir, prune_exports, remove_previous_exports, \
+    write_json_export
+from app.pagination import keyset_batches
+from app.progress import ProgressReporter
 #from app.errors import errors
 from app.errors.errors import TimeoutException
-from datetime import datetime
+from datetime import datetime, timedelta
 
 app = create_app()
 app.app_context().push()
 
-def _set_task_progress(progress):
-    app.logger.info('Setting task progress...')
-    job = get_current_job()
-    if job:
-        job.meta['progress'] = progress
-        job.save_meta()
-        task = db.session.get(Task, job.get_id())
-        task.user.add_notification('task_progress', {'task_id': job.get_id(),
-                                                     'progress': progress})
-        if progress >= 100:
-            task.complete = True
-        db.session.commit()
-        app.logger.info('Progress for Redis job_id {0} updated to {1}'.format(job.get_id(), progress))
-
-
 # dummy function to export all companions a user has. Not useful in itself, but code will be!
 # eventually switch this to export chat history
-def export_companions(user_id, max_runtime=120):
+def export_companions(user_id, max_runtime=None):
+    max_runtime = max_runtime or app.config['EXPORT_MAX_RUNTIME']
+    progress = ProgressReporter()
     try:
         app.logger.info('Exporting companions for user_id {0}'.format(user_id))
         signal.alarm(max_runtime)
-        #start_time = datetime.now()
         user = db.session.get(User, user_id)
-        _set_task_progress(0)
-        app.logger.info('Setting export_companion progress to 0')
-        data = []
-        i = 0
-        companion_list = db.session.scalar(sa.select(sa.func.count()).select_from(
-            user.companions.select().subquery()))
-        app.logger.info('Companion list pulled successfully')
-        for comp in db.session.scalars(user.companions.select().order_by(
-                Companion.created_at_ts.asc())):
-            data.append({'name': comp.companion_name,
-                         'timestamp': comp.created_at_ts.isoformat() + 'Z'})
-            time.sleep(5)
-            i += 1
-            _set_task_progress(100 * i // companion_list)
-        app.logger.info('Companion list successfully generated in list form to send email')
-        app.logger.info('Now ensuring email params are set correctly...')
-        app.logger.info('Sender: {0} Recipient: {1}...should be enough'.format(app.config['ADMINS'][0], [user.email]))
+        progress.update(0)
+        query = user.companions.select().with_only_columns(
+            Companion.id, Companion.companion_name, Companion.created_at_ts)
+        total = db.session.scalar(sa.select(sa.func.count()).select_from(
+            query.subquery()))
+
+        def rows():
+            # rows are fetched EXPORT_BATCH_SIZE at a time and written out as
+            # they arrive; each batch is a SELECT of its own, so nothing is
+            # left streaming while progress is committed
+            batches = keyset_batches(
+                query, [Companion.created_at_ts, Companion.id],
+                app.config['EXPORT_BATCH_SIZE'])
+            for i, (_, name, created_at) in enumerate(batches, 1):
+                yield {'name': name, 'timestamp': created_at.isoformat() + 'Z'}
+                progress.update(100 * i // total)
+
+        job = progress.job
+        compress = app.config['EXPORT_COMPRESS']
+        filename = 'companions-{0}.json{1}'.format(
+            job.get_id() if job else int(time.time()), '.gz' if compress else '')
+        path = os.path.join(export_dir(user_id), filename)
+        count = write_json_export(path, 'companions', rows(), compress=compress)
+        app.logger.info('Exported {0} companions to {1}'.format(count, path))
+        remove_previous_exports(user_id, filename)
+
+        attachments = download_url = None
+        if os.path.getsize(path) <= app.config['EXPORT_ATTACHMENT_MAX']:
+            with open(path, 'rb') as f:
+                attachments = [(filename, 'application/gzip' if compress
+                                else 'application/json', f.read())]
+        else:
+            with app.test_request_context(base_url=app.config['APP_URL']):
+                download_url = url_for('main.download_export',
+                                       filename=filename, _external=True)
         send_email(
             '[AICompanion] Your created companions:',
             sender=app.config['ADMINS'][0], recipients=[user.email],
-            text_body=render_template('email/export_companions.txt', user=user),
-            html_body=render_template('email/export_companions.html', user=user),
-            attachments=[('companions.json', 'application/json',
-                          json.dumps({'companions': data}, indent=4))],
-            sync=True)
-        #runtime = timedelta(seconds=datetime.now() - start_time)
-        #app.logger.info('Runtime for this is {0}'.format(runtime))
-        #if (runtime > max_runtime):
-        #    raise MaxRuntimeException:
-        #        _set_task_progress(100)
-        #        app.logger.error('Runtime exceeds maximum runtime of {0} seconds, cancelling job and exiting.'.format(max_runtime), exc_info=sys.exc_info())
+            text_body=render_template('email/export_companions.txt', user=user,
+                                      download_url=download_url),
+            html_body=render_template('email/export_companions.html', user=user,
+                                      download_url=download_url),
+            attachments=attachments, sync=True)
     except TimeoutException:
-        _set_task_progress(100)
+        db.session.rollback()
         app.logger.error('Runtime exceeds maximum runtime of {0} seconds, cancelling job and exiting.'.format(max_runtime), exc_info=sys.exc_info())
     except Exception:
-        _set_task_progress(100)
+        db.session.rollback()
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        signal.alarm(0)
+        app.logger.info('Export companion function completed for user {0}'.format(user_id))
+        progress.finish()
+
+
+def mark_task_complete(job, connection, *args):
+    # success, failure and stopped callback of every job started with
+    # User.launch_task, so a job that ends before reporting 100% doesn't stay
+    # listed as running
+    try:
+        Task.mark_complete([job.id])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def send_queued_email(msg):
+    # failures propagate so RQ retries the job per the Retry it was queued
+    # with; mail.send opens one connection per message, which the worker can
+    # afford since it is off the request path
+    mail.send(msg)
+
+
+def index_search_outbox():
+    app.redis.delete(DRAIN_SCHEDULED_KEY)
+    batch_size = app.config['SEARCH_OUTBOX_BATCH_SIZE']
+    try:
+        while SearchOutbox.drain(batch_size) == batch_size:
+            pass
+        pending, lag = SearchOutbox.lag()
+        app.logger.info('Search outbox drained, {0} entries pending, '
+                        'lag {1:.1f}s'.format(pending, lag))
+        if pending:
+            delay = max(SearchOutbox.next_retry_at() - time.time(), 1)
+            app.task_queue.enqueue_in(timedelta(seconds=delay),
+                                      'app.tasks.index_search_outbox')
+    except Exception:
+        db.session.rollback()
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def detect_message_languages():
+    app.redis.delete(DETECT_SCHEDULED_KEY)
+    try:
+        count = detect_queued(app.config['LANGDETECT_BATCH_SIZE'])
+        app.logger.info('Detected the language of {0} messages'.format(count))
+    except Exception:
+        db.session.rollback()
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def prune_notifications():
+    def report(rows, seconds):
+        app.logger.info('Pruned {0} notifications in {1:.3f}s'.format(
+            rows, seconds))
+
+    days = app.config['NOTIFICATION_RETENTION_DAYS']
+    try:
+        deleted = Notification.prune(
+            time.time() - days * 86400,
+            chunk_size=app.config['NOTIFICATION_PRUNE_CHUNK'],
+            pause=app.config['NOTIFICATION_PRUNE_PAUSE'], report=report)
+        app.logger.info('Pruned {0} notifications older than {1} days'.format(
+            deleted, days))
+        # tasks whose job ended without its callback stay listed otherwise
+        completed = Task.complete_finished()
+        app.logger.info('Marked {0} finished tasks complete'.format(completed))
+        removed = prune_exports(app.config['EXPORT_RETENTION_DAYS'] * 86400)
+        app.logger.info('Removed {0} expired exports'.format(removed))
+    except Exception:
+        db.session.rollback()
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
     finally:
-        app.logger.info('Export companion function successfully completed for user {0}'.format(user_id))
-        _set_task_progress(100)
-        signal.alarm(0)
\ No newline at end of file
+        interval = app.config['NOTIFICATION_PRUNE_INTERVAL']
+        if interval:
+            app.task_queue.enqueue_in(timedelta(seconds=interval),
+                                      'app.tasks.prune_notifications')
@@ -1,13 +1,78 @@
 #!/usr/bin/env python
 from datetime import datetime, timezone, timedelta
+import gzip
+import json
+import os
+import re
+import smtplib
+import sqlite3
+import tempfile
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from contextlib import contextmanager
+from unittest import mock
+from flask import g
+from flask_login import FlaskLoginClient
+import redis
+from elasticsearch import ApiError
+from rq.job import JobStatus
+from app import create_app, db, tasks
+import sqlalchemy as sa
+from app.models import User, Companion, Message, Notification, \
+    SearchOutbox, Task, reconcile_counters, token_cache, user_cache
+from app.presence import record_last_seen, flush_last_seen
+from app.notifications import notification_events
+from app.db_pool import TimedQueuePool, pool_stats
+from app.db_routing import ReplicaSet, sticky_clients
+from app.email import MailPool
+from app.exports import export_dir, prune_exports, write_json_export
+from app.language import detect_all, detect_queued
+from app.progress import ProgressReporter
+from app.seed import Seeder
+from app.pagination import keyset_paginate, offset_paginate
+from app.search import ElasticsearchBackend, SQLiteSearchBackend, \
+    result_cache
+from app.translate import translate, translate_many, translation_cache
 from config import Config
 
+# queries each listed view may issue for a page of rows, whatever the number
+# of rows; going over means a relationship is being loaded per row
+VIEW_QUERY_BUDGETS = [
+    ('/index', 5),
+    ('/messages', 6),
+    ('/search?q=hello', 4),
+    ('/user/u1/popup', 3),
+]
+
+
+@contextmanager
+def count_queries(engine, parameters=False):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, params, context,
+                              executemany):
+        if parameters:
+            if not executemany:
+                statements.append((statement, params))
+        else:
+            statements.append(statement)
+    sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute',
+                        before_cursor_execute)
+
+
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # in-memory SQLite runs on a single static connection
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    RAISE_ON_LAZY_LOAD = True
+    PRESENCE_FLUSH_INTERVAL = 0
+    SEARCH_SQLITE_PATH = ':memory:'
+    TRANSLATION_PROVIDER = 'local'
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
@@ -32,6 +97,939 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
+        self.assertEqual(u.avatar_digest, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'John@Example.com'
+        self.assertEqual(u.avatar_digest, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        self.assertNotEqual(u.avatar_digest,
+                            'd4c74594d841139328695756648b6bd6')
+
+    def test_local_avatar(self):
+        digest = 'd4c74594d841139328695756648b6bd6'
+        self.app.config['AVATAR_PROVIDER'] = 'local'
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(64), f'/avatar/{digest}/64')
+        client = self.app.test_client()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.app.config['AVATAR_CACHE_DIR'] = cache_dir
+            response = client.get(f'/avatar/{digest}/64')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'image/png')
+            self.assertTrue(response.data.startswith(b'\x89PNG'))
+            etag, weak = response.get_etag()
+            self.assertFalse(weak)
+            self.assertTrue(response.cache_control.immutable)
+            self.assertEqual(response.cache_control.max_age,
+                             self.app.config['AVATAR_MAX_AGE'])
+            self.assertEqual(len(os.listdir(os.path.join(cache_dir, 'd4'))),
+                             1)
+
+            again = client.get(f'/avatar/{digest}/64',
+                               headers={'If-None-Match': f'"{etag}"'})
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.data, b'')
+            self.assertEqual(client.get(f'/avatar/{digest}/64').data,
+                             response.data)
+            self.assertNotEqual(client.get(f'/avatar/{digest}/128').data,
+                                response.data)
+            self.assertEqual(len(os.listdir(os.path.join(cache_dir, 'd4'))),
+                             2)
+
+            # drawn for anyone, but only users' digests are kept
+            unknown = client.get('/avatar/0123456789abcdef0123456789abcdef/64')
+            self.assertEqual(unknown.status_code, 200)
+            self.assertTrue(unknown.data.startswith(b'\x89PNG'))
+            self.assertFalse(os.path.exists(os.path.join(cache_dir, '01')))
+        self.assertEqual(client.get('/avatar/nothex/64').status_code, 404)
+        self.assertEqual(client.get(f'/avatar/{digest}/32').status_code, 404)
+
+    def test_last_seen_buffered_until_flush(self):
+        u = User(username='john', email='john@example.com',
+                 last_seen=datetime(2024, 1, 1))
+        db.session.add(u)
+        db.session.commit()
+        now = datetime(2024, 1, 2, tzinfo=timezone.utc)
+        self.assertTrue(record_last_seen(u, now=now.timestamp()))
+        self.assertFalse(record_last_seen(u, now=now.timestamp() + 1))
+        self.assertEqual(u.get_last_seen(), now)
+        self.assertEqual(u.last_seen, datetime(2024, 1, 1))
+
+        # a failed write keeps the batch for the next flush
+        with mock.patch.object(db.session, 'commit',
+                               side_effect=sa.exc.OperationalError(
+                                   'COMMIT', {}, Exception('lost'))):
+            with self.assertRaises(sa.exc.OperationalError):
+                flush_last_seen()
+        db.session.rollback()
+        self.assertEqual(u.get_last_seen(), now)
+
+        self.assertEqual(flush_last_seen(), 1)
+        db.session.refresh(u)
+        self.assertEqual(u.last_seen, datetime(2024, 1, 2))
+        self.assertEqual(flush_last_seen(), 0)
+
+    def test_api_users_last_seen_in_one_lookup(self):
+        users = [User(username=name, email=f'{name}@example.com',
+                      last_seen=datetime(2024, 1, 1))
+                 for name in ('john', 'susan', 'mary')]
+        db.session.add_all(users)
+        token = users[0].get_token()
+        db.session.commit()
+        now = datetime(2024, 1, 2, tzinfo=timezone.utc)
+        record_last_seen(users[1], now=now.timestamp())
+        client = self.app.test_client()
+        with mock.patch.object(self.app.redis, 'hget') as hget, \
+                mock.patch.object(self.app.redis, 'hmget',
+                                  wraps=self.app.redis.hmget) as hmget:
+            data = client.get('/api/users', headers={
+                'Authorization': 'Bearer ' + token}).get_json()
+        self.assertEqual(hmget.call_count, 1)
+        hget.assert_not_called()
+        self.assertEqual([user['last_seen'] for user in data['items']], [
+            '2024-01-01T00:00:00+00:00', now.isoformat(),
+            '2024-01-01T00:00:00+00:00'])
+        flush_last_seen()
+
+    def test_notification_streams_capped_per_process(self):
+        self.app.config['SECRET_KEY'] = 'test'
+        self.app.config['NOTIFICATION_STREAM_MAX'] = 1
+        self.app.config['NOTIFICATION_STREAM_TIMEOUT'] = 0
+        self.app.test_client_class = FlaskLoginClient
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client(user=u)
+        pubsub = mock.Mock(return_value=FakePubSub([]))
+        with mock.patch.object(self.app.redis, 'pubsub', pubsub):
+            first = client.get('/notifications/stream', buffered=False)
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(client.get('/notifications/stream').status_code,
+                             503)
+            first.close()
+            again = client.get('/notifications/stream')
+            self.assertEqual(again.status_code, 200)
+            self.assertEqual(again.get_data(as_text=True), 'retry: 2000\n\n')
+
+    def test_notifications_published_on_commit(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('unread_message_count', 3)
+        self.assertEqual(len(db.session.info['notifications']), 1)
+        db.session.commit()
+        self.assertNotIn('notifications', db.session.info)
+        u.add_notification('unread_message_count', 4)
+        db.session.rollback()
+        self.assertNotIn('notifications', db.session.info)
+
+    def test_notification_upsert_and_prune(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        db.session.refresh(u)
+        for count in (3, 4):
+            with count_queries(db.engine) as statements:
+                u.add_notification('unread_message_count', count)
+            self.assertEqual(len(statements), 1)
+            self.assertIn('ON CONFLICT', statements[0])
+        u.add_notification('task_progress', {'progress': 10})
+        db.session.commit()
+        notifications = {n.name: n for n in db.session.scalars(
+            u.notifications.select())}
+        self.assertEqual(len(notifications), 2)
+        self.assertEqual(notifications['unread_message_count'].get_data(), 4)
+
+        db.session.add_all([Notification(user=u, name=f'old{i}',
+                                         payload_json='0', timestamp=i)
+                            for i in range(5)])
+        db.session.commit()
+        chunks = []
+        deleted = Notification.prune(
+            100, chunk_size=2,
+            report=lambda rows, seconds: chunks.append(rows))
+        self.assertEqual(deleted, 5)
+        self.assertEqual(chunks, [2, 2, 1])
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count(Notification.id))), 2)
+
+    def test_language_detection(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        bodies = ['the weather is lovely today and I went for a walk',
+                  'hoy hace muy buen tiempo y fuimos a la playa',
+                  '12345', 'where are you going this weekend?']
+        with mock.patch('app.models.schedule_language_detection') as schedule:
+            db.session.add_all([Message(author=u1, recipient=u2, body=body)
+                                for body in bodies])
+            db.session.commit()
+        schedule.assert_called_once_with([1, 2, 3, 4])
+
+        # the job takes the queued ids from Redis
+        with mock.patch.object(self.app.redis, 'spop',
+                               side_effect=[[b'2', b'3'], []]):
+            self.assertEqual(detect_queued(10), 2)
+        reports = []
+        with count_queries(db.engine) as statements:
+            self.assertEqual(detect_all(1, workers=2, report=lambda *args:
+                                        reports.append(args[0])), 2)
+        updates = [s for s in statements if s.startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(reports, [2])
+        languages = db.session.scalars(sa.select(Message.language).order_by(
+            Message.id)).all()
+        self.assertEqual(languages, ['en', 'es', '', 'en'])
+        self.assertEqual(detect_all(10), 0)
+
+    def test_translation_cache(self):
+        translation_cache.local.clear()
+        translator = self.app.translator
+        self.assertEqual(translate_many(['hola', 'adios', 'hola'], 'es', 'en'),
+                         ['[es>en] hola', '[es>en] adios', '[es>en] hola'])
+        self.assertEqual(translator.calls, 1)
+        self.assertEqual(translate('hola', 'es', 'en'), '[es>en] hola')
+        self.assertEqual(translate_many(['adios', 'hola'], 'es', 'en'),
+                         ['[es>en] adios', '[es>en] hola'])
+        self.assertEqual(translator.calls, 1)
+        self.assertEqual(translate('hola', 'es', 'fr'), '[es>fr] hola')
+        self.assertEqual(translator.calls, 2)
+        # another provider doesn't get the stand-in's translations
+        self.app.config['TRANSLATION_PROVIDER'] = 'microsoft'
+        translate('hola', 'es', 'en')
+        self.assertEqual(translator.calls, 3)
+        self.app.config['TRANSLATION_PROVIDER'] = 'local'
+
+        translator.max_batch = 2
+        translate_many([str(i) for i in range(5)], 'es', 'en')
+        self.assertEqual(translator.calls, 6)
+        # batches are cut by their length in characters too
+        translator.max_batch, translator.max_chars = 100, 10
+        translate_many([f'text{i}' for i in range(5)], 'es', 'en')
+        self.assertEqual(translator.calls, 9)
+
+    def test_translate_batch_endpoint(self):
+        translation_cache.local.clear()
+        self.app.config['SECRET_KEY'] = 'test'
+        self.app.test_client_class = FlaskLoginClient
+        u = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([u, susan] + [
+            Message(author=u, recipient=u, body=body, language=language)
+            for body, language in (('hola', 'es'), ('bonjour', 'fr'),
+                                   ('hola', 'es'), ('hello', 'en'))] + [
+            Message(author=susan, recipient=susan, body='secreto',
+                    language='es')])
+        db.session.commit()
+        client = self.app.test_client(user=u)
+        # only the user's stored messages are translated, by their own
+        # language; susan's message 5 is dropped
+        response = client.post('/translate/batch', json={
+            'dest_language': 'en', 'ids': [1, 2, 3, 4, 5, 99]})
+        self.assertEqual(response.get_json(), {'translations': {
+            '1': '[es>en] hola', '2': '[fr>en] bonjour',
+            '3': '[es>en] hola'}})
+        self.assertEqual(self.app.translator.calls, 2)
+        response = client.post('/translate', json={
+            'id': 3, 'dest_language': 'en'})
+        self.assertEqual(response.get_json(), {'text': '[es>en] hola'})
+        self.assertEqual(self.app.translator.calls, 2)
+
+        self.assertEqual(client.post('/translate', json={
+            'id': 5, 'dest_language': 'en'}).status_code, 404)
+        self.assertEqual(client.post('/translate', json={
+            'text': 'hola', 'source_language': 'es',
+            'dest_language': 'en'}).status_code, 400)
+        self.assertEqual(client.post('/translate/batch', json={
+            'dest_language': 'en', 'ids': ['1']}).status_code, 400)
+        self.assertEqual(client.post('/translate/batch', json={
+            'dest_language': 'en', 'messages': [
+                {'id': 1, 'text': 'hi', 'source_language': 'es'}]}
+        ).status_code, 400)
+        self.app.translator = None
+        self.assertEqual(client.post('/translate/batch', json={
+            'dest_language': 'fr', 'ids': [1]}).status_code, 503)
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        # pairs of messages share a timestamp so the id breaks the tie
+        now = datetime(2024, 1, 1)
+        db.session.add_all([
+            Message(author=u1, recipient=u2, body=str(i),
+                    timestamp=now + timedelta(seconds=i // 2))
+            for i in range(7)])
+        db.session.commit()
+        query = u2.messages_received.select()
+        columns = [Message.timestamp, Message.id]
+
+        page1 = keyset_paginate(query, columns, None, 3, descending=True)
+        self.assertEqual([m.body for m in page1.items], ['6', '5', '4'])
+        self.assertIsNone(page1.prev_cursor)
+        page2 = keyset_paginate(query, columns, page1.next_cursor, 3,
+                                descending=True)
+        self.assertEqual([m.body for m in page2.items], ['3', '2', '1'])
+        page3 = keyset_paginate(query, columns, page2.next_cursor, 3,
+                                descending=True)
+        self.assertEqual([m.body for m in page3.items], ['0'])
+        self.assertIsNone(page3.next_cursor)
+        back = keyset_paginate(query, columns, page2.prev_cursor, 3,
+                               descending=True)
+        self.assertEqual([m.body for m in back.items], ['6', '5', '4'])
+        self.assertIsNone(back.prev_cursor)
+
+        items, has_next = offset_paginate(
+            query.order_by(Message.timestamp.desc(), Message.id.desc()), 3, 3)
+        self.assertEqual([m.body for m in items], ['0'])
+        self.assertFalse(has_next)
+
+    def test_denormalized_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual(u1.companion_count, 0)
+
+        c = Companion(companion_name='ai', creator=u1)
+        db.session.add_all([c, Companion(companion_name='bot', creator=u1)])
+        m1 = Message(author=u1, recipient=u2, body='hi')
+        m2 = Message(author=u1, recipient=u2, body='there')
+        db.session.add_all([m1, m2])
+        db.session.commit()
+        self.assertEqual(u1.companion_count, 2)
+        self.assertEqual(u2.unread_message_count, 2)
+
+        db.session.delete(c)
+        db.session.delete(m1)
+        db.session.commit()
+        self.assertEqual(u1.companion_count, 1)
+        self.assertEqual(u2.unread_message_count, 1)
+
+        u2.last_message_read_time = datetime.now(timezone.utc)
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count, 0)
+
+        db.session.execute(sa.update(User).values(companion_count=7))
+        db.session.commit()
+        self.assertEqual(reconcile_counters(batch_size=1), 2)
+        self.assertEqual(u1.companion_count, 1)
+        self.assertEqual(u2.companion_count, 0)
+        self.assertEqual(reconcile_counters(), 0)
+
+    def test_token_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+        token_cache.local.clear()
+        hits, misses = token_cache.hits, token_cache.misses
+
+        self.assertEqual(User.check_token(token), u)
+        db.session.expunge_all()
+        cached = User.check_token(token)
+        self.assertEqual(cached.username, 'john')
+        self.assertEqual(token_cache.hits - hits, 1)
+        self.assertEqual(token_cache.misses - misses, 1)
+
+        cached.revoke_token()
+        db.session.commit()
+        self.assertIsNone(token_cache.local.get(token))
+        self.assertIsNone(User.check_token(token))
+
+    def test_user_identity_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user_cache.local.clear()
+        hits = user_cache.hits
+
+        self.assertEqual(User.get_by_username('john').id, u.id)
+        db.session.expunge_all()
+        cached = User.get_by_username('john')
+        self.assertEqual(user_cache.hits - hits, 1)
+        self.assertEqual(cached.email, 'john@example.com')
+        self.assertIs(User.get_cached(u.id), cached)
+
+        cached.username = 'johnny'
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertIsNone(User.get_by_username('john'))
+        self.assertEqual(User.get_cached(u.id).username, 'johnny')
+
+        db.session.delete(User.get_cached(u.id))
+        db.session.commit()
+        self.assertIsNone(User.get_cached(u.id))
+
+    def test_search_outbox(self):
+        self.app.search_backend = ElasticsearchBackend(mock.Mock(),
+                                                       self.app.logger)
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        m = Message(author=u1, recipient=u2, body='hello')
+        db.session.add_all([u1, u2, m])
+        db.session.commit()
+        m.body = 'hello again'
+        db.session.commit()
+        self.assertEqual(SearchOutbox.lag()[0], 2)
+
+        with mock.patch('app.models.bulk_index',
+                        return_value={('message', m.id)}) as bulk_index:
+            self.assertEqual(SearchOutbox.drain(10), 2)
+        actions = bulk_index.call_args[0][0]
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0]['_source'], {'body': 'hello again'})
+        self.assertEqual(SearchOutbox.drain(10), 0)
+
+        db.session.execute(sa.update(SearchOutbox).values(next_attempt_at=0))
+        db.session.delete(m)
+        db.session.commit()
+        with mock.patch('app.models.bulk_index',
+                        return_value=set()) as bulk_index:
+            self.assertEqual(SearchOutbox.drain(10), 3)
+        self.assertEqual(bulk_index.call_args[0][0][0]['_op_type'], 'delete')
+        self.assertEqual(SearchOutbox.lag()[0], 0)
+
+        # an entry that keeps failing is parked instead of retried forever
+        self.app.config['SEARCH_OUTBOX_MAX_ATTEMPTS'] = 2
+        m2 = Message(author=u1, recipient=u2, body='rejected')
+        db.session.add(m2)
+        db.session.commit()
+        for _ in range(2):
+            db.session.execute(sa.update(SearchOutbox).values(
+                next_attempt_at=0))
+            with mock.patch('app.models.bulk_index',
+                            return_value={('message', m2.id)}):
+                self.assertEqual(SearchOutbox.drain(10), 1)
+        db.session.execute(sa.update(SearchOutbox).values(next_attempt_at=0))
+        self.assertEqual(SearchOutbox.drain(10), 0)
+        self.assertEqual(SearchOutbox.lag()[0], 0)
+        self.assertEqual(SearchOutbox.parked_count(), 1)
+        self.assertEqual(SearchOutbox.unpark(), 1)
+        self.assertEqual(SearchOutbox.lag()[0], 1)
+
+    def test_reindex_in_batches(self):
+        self.app.search_backend = ElasticsearchBackend(mock.Mock(),
+                                                       self.app.logger)
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([Message(author=u1, recipient=u2, body=str(i))
+                            for i in range(7)])
+        db.session.commit()
+        with mock.patch('app.search.bulk', return_value=(0, [])) as bulk:
+            self.assertEqual(Message.reindex(batch_size=3, workers=2), 7)
+        # batches are shipped from a thread pool, in no particular order
+        batches = sorted((call[0][1] for call in bulk.call_args_list),
+                         key=lambda batch: batch[0]['_id'])
+        self.assertEqual([len(b) for b in batches], [3, 3, 1])
+        self.assertEqual(batches[2][0]['_source'], {'body': '6'})
+
+    def test_embedded_search(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        m1 = Message(author=u1, recipient=u2, body='the cat sat')
+        m2 = Message(author=u1, recipient=u2, body='cats and cats and dogs')
+        m3 = Message(author=u1, recipient=u2, body='nothing to see')
+        db.session.add_all([m1, m2, m3])
+        db.session.commit()
+
+        results, total = Message.search('cat', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(list(results), [m2, m1])
+        results, total = Message.search('dogs OR "', 1, 10)
+        self.assertEqual(list(results), [m2])
+
+        m2.body = 'no pets'
+        db.session.delete(m1)
+        db.session.commit()
+        self.assertEqual(Message.search('cat', 1, 10), ([], 0))
+        self.assertEqual(Message.search('pets', 1, 10)[1], 1)
+
+    def test_embedded_search_table_created_by_another_worker(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'search.db')
+            reader = SQLiteSearchBackend(path)
+            writer = SQLiteSearchBackend(path)
+            self.assertEqual(reader.query('message', 'cat', 1, 10), ([], 0))
+            writer.bulk([{'_op_type': 'index', '_index': 'message',
+                          '_id': 1, '_source': {'body': 'the cat sat'}}])
+            self.assertEqual(reader.query('message', 'cat', 1, 10), ([1], 1))
+            reader.bulk([{'_op_type': 'delete', '_index': 'message',
+                          '_id': 1}])
+            self.assertEqual(writer.query('message', 'cat', 1, 10), ([], 0))
+            reader._conn.close()
+            writer._conn.close()
+
+    def test_search_result_cache(self):
+        result_cache.local.clear()
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        m1 = Message(author=u1, recipient=u2, body='the cat sat')
+        db.session.add_all([u1, u2, m1])
+        db.session.commit()
+        backend = self.app.search_backend
+        with mock.patch.object(backend, 'query',
+                               wraps=backend.query) as query:
+            self.assertEqual(list(Message.search('Cat', 1, 10)[0]), [m1])
+            self.assertEqual(list(Message.search(' cat ', 1, 10)[0]), [m1])
+            self.assertEqual(query.call_count, 1)
+
+            # a commit that touches the index invalidates the entry
+            m2 = Message(author=u2, recipient=u1, body='cat nap')
+            db.session.add(m2)
+            db.session.commit()
+            self.assertEqual(Message.search('cat', 1, 10)[1], 2)
+            self.assertEqual(query.call_count, 2)
+
+        with mock.patch.object(backend, 'query',
+                               side_effect=sqlite3.OperationalError):
+            m2.body = 'dog nap'
+            db.session.commit()
+            self.assertEqual(Message.search('cat', 1, 10)[1], 2)
+            with self.assertRaises(sqlite3.OperationalError):
+                Message.search('dog', 1, 10)
+        # Elasticsearch answering 429 or 5xx raises ApiError
+        rejected = ApiError('rejected', meta=mock.Mock(status=429), body={})
+        with mock.patch.object(backend, 'query', side_effect=rejected):
+            self.assertEqual(Message.search('cat', 1, 10)[1], 2)
+            with self.assertRaises(ApiError):
+                Message.search('dog', 1, 10)
+
+    def test_streamed_export(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.app.config['EXPORT_DIR'] = tmp
+            rows = ({'name': str(i)} for i in range(3))
+            path = os.path.join(export_dir(1), 'c.json.gz')
+            self.assertEqual(write_json_export(path, 'companions', rows,
+                                               compress=True), 3)
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual(json.load(f), {'companions': [
+                    {'name': '0'}, {'name': '1'}, {'name': '2'}]})
+            self.assertEqual(os.listdir(export_dir(1)), ['c.json.gz'])
+
+            def failing():
+                yield {'name': 'x'}
+                raise RuntimeError
+            with self.assertRaises(RuntimeError):
+                write_json_export(os.path.join(export_dir(2), 'c.json'),
+                                  'companions', failing())
+            self.assertEqual(os.listdir(export_dir(2)), [])
+
+    def test_export_companions_task(self):
+        u = User(username='john', email='john@example.com')
+        # pairs share a timestamp so the id breaks the tie between batches
+        now = datetime(2024, 1, 1)
+        db.session.add_all([u, Task(id='job', name='export_companions',
+                                    user=u)] + [
+            Companion(creator=u, companion_name=str(i),
+                      created_at_ts=now + timedelta(seconds=i // 2))
+            for i in range(12)])
+        db.session.commit()
+        job = mock.Mock(meta={})
+        job.get_id.return_value = 'job'
+        self.app.config['EXPORT_BATCH_SIZE'] = 5
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch('app.tasks.app', self.app), \
+                mock.patch('app.tasks.send_email') as send_email, \
+                mock.patch('app.progress.get_current_job', return_value=job):
+            self.app.config['EXPORT_DIR'] = tmp
+            # an earlier export of this user's is replaced
+            write_json_export(os.path.join(export_dir(u.id),
+                                           'companions-old.json'),
+                              'companions', [])
+            tasks.export_companions(u.id)
+            self.assertEqual(os.listdir(export_dir(u.id)),
+                             ['companions-job.json'])
+            with open(os.path.join(export_dir(u.id),
+                                   'companions-job.json')) as f:
+                exported = json.load(f)['companions']
+            self.assertEqual(prune_exports(60), 0)
+            self.assertEqual(prune_exports(-1), 1)
+            self.assertEqual(os.listdir(tmp), [])
+        self.assertEqual([c['name'] for c in exported],
+                         [str(i) for i in range(12)])
+        self.assertEqual(len(send_email.call_args.kwargs['attachments']), 1)
+        self.assertGreater(job.meta['progress_writes'], 3)
+        self.assertEqual(job.meta['progress'], 100)
+        self.assertTrue(db.session.get(Task, 'job').complete)
+
+    def test_progress_reporter(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Task(id='job', name='export', user=u)])
+        db.session.commit()
+        job = mock.Mock(meta={})
+        job.get_id.return_value = 'job'
+        with ProgressReporter(job, rate=1e-6, step=10) as progress:
+            for i in range(99):
+                progress.update(i)
+        self.assertEqual(job.save_meta.call_count, 11)
+        self.assertEqual(job.meta, {'progress': 100, 'progress_updates': 100,
+                                    'progress_writes': 11})
+        notifications = db.session.scalars(u.notifications.select()).all()
+        self.assertEqual(len(notifications), 1)
+        self.assertEqual(notifications[0].get_data(),
+                         {'task_id': 'job', 'progress': 100})
+        self.assertTrue(db.session.get(Task, 'job').complete)
+
+    def test_progress_reporter_leaves_caller_session_alone(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Task(id='job', name='export', user=u)])
+        db.session.commit()
+        job = mock.Mock(meta={})
+        job.get_id.return_value = 'job'
+        u.about_me = 'unsaved'
+        with mock.patch('app.notifications.publish_notification') as publish:
+            ProgressReporter(job).update(50)
+        publish.assert_called_once()
+        self.assertIn(u, db.session.dirty)
+        db.session.rollback()
+        self.assertIsNone(u.about_me)
+        self.assertEqual(db.session.scalar(u.notifications.select()).get_data(),
+                         {'task_id': 'job', 'progress': 50})
+
+    def test_task_progress_batch(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u] + [Task(id=id, name='export', user=u)
+                                  for id in ('gone', 'done', 'running')])
+        db.session.commit()
+        done = mock.Mock(meta={'progress': 100})
+        done.get_status.return_value = JobStatus.FINISHED
+        running = mock.Mock(meta={'progress': 40})
+        running.get_status.return_value = JobStatus.STARTED
+        with mock.patch('rq.job.Job.fetch_many',
+                        return_value=[None, done, running]) as fetch_many:
+            self.assertEqual(
+                [(task.id, progress) for task, progress
+                 in u.get_task_progress()], [('running', 40)])
+        fetch_many.assert_called_once()
+        # reading progress never writes; the worker marks tasks complete
+        self.assertEqual(
+            sorted(task.id for task in u.get_tasks_in_progress()),
+            ['done', 'gone', 'running'])
+        with mock.patch('rq.job.Job.fetch_many',
+                        return_value=[None, done, running]):
+            self.assertEqual(u.get_task_in_progress('export').id, 'running')
+        with mock.patch('rq.job.Job.fetch_many',
+                        return_value=[None, done, None]):
+            self.assertIsNone(u.get_task_in_progress('export'))
+        tasks.mark_task_complete(mock.Mock(id='done'), None)
+        self.assertEqual(
+            sorted(task.id for task in u.get_tasks_in_progress()),
+            ['gone', 'running'])
+
+        # 'gone' ended without its callback, as when its worker is killed
+        with mock.patch('rq.job.Job.fetch_many',
+                        side_effect=redis.exceptions.ConnectionError):
+            self.assertEqual(Task.complete_finished(), 0)
+        with mock.patch('rq.job.Job.fetch_many',
+                        return_value=[None, running]) as fetch_many:
+            self.assertEqual(Task.complete_finished(batch_size=10), 1)
+        fetch_many.assert_called_once()
+        self.assertEqual([task.id for task in u.get_tasks_in_progress()],
+                         ['running'])
+
+    def test_mail_pool_reuses_connections(self):
+        self.app.config.update(MAIL_POOL_SIZE=2, MAIL_POOL_IDLE=0.5)
+        pool = MailPool(self.app)
+        conn = mock.MagicMock()
+        conn.__enter__.return_value = conn
+        # the first attempt at one message fails and is retried
+        conn.send.side_effect = [smtplib.SMTPServerDisconnected] + \
+            [None] * 20
+        with mock.patch('app.email.mail.connect', return_value=conn), \
+                mock.patch('app.email.time.sleep'):
+            for i in range(20):
+                pool.submit(i)
+            self.assertTrue(pool.join(timeout=5))
+        stats = pool.stats()
+        self.assertEqual((stats['sent'], stats['retried'], stats['failed']),
+                         (20, 1, 0))
+        self.assertLessEqual(stats['connections'], 3)
+
+    def test_pool_telemetry(self):
+        pool_stats.reset()
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = sa.create_engine(
+                'sqlite:///' + os.path.join(tmp, 'pool.db'),
+                poolclass=TimedQueuePool, pool_size=1, max_overflow=1,
+                pool_timeout=0.1)
+            first, second = engine.connect(), engine.connect()
+            with self.assertRaises(sa.exc.TimeoutError):
+                engine.connect()
+            stats = pool_stats.stats()
+            self.assertEqual((stats['checkouts'], stats['overflow_checkouts'],
+                              stats['timeouts'], stats['checked_out']),
+                             (2, 1, 1, 2))
+            # while the overflow connection is open, reusing the pooled one
+            # is not an overflow checkout
+            first.close()
+            engine.connect().close()
+            self.assertEqual(pool_stats.stats()['overflow_checkouts'], 1)
+            second.close()
+            engine.dispose()
+            engine.connect().close()
+            self.assertEqual(pool_stats.stats()['checkouts'], 4)
+            self.assertEqual(pool_stats.stats()['connects'], 3)
+            engine.dispose()
+
+    def test_read_replica_routing(self):
+        sticky_clients.local.clear()
+        with tempfile.TemporaryDirectory() as tmp:
+            self.app.config['SQLALCHEMY_REPLICA_URIS'] = [
+                'sqlite:///' + os.path.join(tmp, 'replica.db')]
+            self.app.db_replicas = replicas = ReplicaSet(self.app)
+            db.metadata.create_all(replicas.engines[0])
+            with replicas.engines[0].begin() as conn:
+                conn.execute(sa.insert(User), {'username': 'replica',
+                                               'email': 'r@example.com'})
+            db.session.add(User(username='primary', email='p@example.com'))
+            db.session.commit()
+            query = sa.select(User.username).order_by(User.id)
+
+            def names(path, method='GET', token='a'):
+                g.pop('_db_replica', None)
+                with self.app.test_request_context(
+                        path, method=method,
+                        headers={'Authorization': 'Bearer ' + token}):
+                    return db.session.scalars(query).all()
+
+            self.assertEqual(names('/api/users'), ['replica'])
+            self.assertEqual(names('/api/users', 'POST'), ['primary'])
+            self.assertEqual(names('/messages'), ['primary'])
+            # other GETs only when asked for, as they may follow a redirect
+            # from a write
+            self.assertEqual(names('/index'), ['primary'])
+            self.app.config['REPLICA_ROUTE_GETS'] = True
+            self.assertEqual(names('/index'), ['replica'])
+            self.app.config['REPLICA_ROUTE_GETS'] = False
+
+            # users read from the replica are not cached
+            user_cache.local.clear()
+            g.pop('_db_replica', None)
+            with self.app.test_request_context(
+                    '/api/users', headers={'Authorization': 'Bearer a'}):
+                self.assertEqual(User.get_cached(1).username, 'replica')
+            self.assertIsNone(user_cache.get('id:1'))
+            db.session.expunge_all()
+            self.assertEqual(User.get_cached(1).username, 'primary')
+            self.assertIsNotNone(user_cache.get('id:1'))
+
+            # after a commit, the same request and then the same client
+            # read their own writes from the primary
+            g.pop('_db_replica', None)
+            with self.app.test_request_context(
+                    '/api/users', headers={'Authorization': 'Bearer a'}):
+                self.assertEqual(db.session.scalars(query).all(), ['replica'])
+                db.session.add(User(username='new', email='n@example.com'))
+                db.session.commit()
+                self.assertEqual(db.session.scalars(query).all(),
+                                 ['primary', 'new'])
+            self.assertEqual(names('/api/users'), ['primary', 'new'])
+            self.assertEqual(names('/api/users', token='b'), ['replica'])
+
+            replicas.mark_down(0)
+            self.assertEqual(names('/api/users', token='b'),
+                             ['primary', 'new'])
+            for engine in replicas.engines:
+                engine.dispose()
+
+    def test_request_metrics(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        client = self.app.test_client()
+        client.get('/auth/reset_password/bad-token')
+        client.get('/auth/reset_password/bad-token')
+        body = client.get('/metrics').get_data(as_text=True)
+        self.assertRegex(body, r'app_request_sql_calls_count\{'
+                               r'endpoint="auth.reset_password"\} [2-9]')
+        self.assertIn('app_request_duration_seconds_bucket', body)
+        self.assertIn('app_search_outbox_pending 0.0', body)
+        self.assertIn('app_search_outbox_parked 0.0', body)
+        self.assertIn('app_cache_lookups{cache="user"', body)
+        self.assertNotIn('endpoint="metrics.metrics"', body)
+
+        # the outbox gauge is served from the last query for a while
+        with mock.patch.object(SearchOutbox, 'lag') as lag:
+            client.get('/metrics')
+        lag.assert_not_called()
+
+        remote = {'REMOTE_ADDR': '203.0.113.9'}
+        self.assertEqual(client.get('/metrics', environ_base=remote)
+                         .status_code, 403)
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(client.get('/metrics', environ_base=remote, headers={
+            'Authorization': 'Bearer wrong'}).status_code, 403)
+        self.assertEqual(client.get('/metrics', environ_base=remote, headers={
+            'Authorization': 'Bearer secret'}).status_code, 200)
+
+    def test_view_query_budgets(self):
+        self.app.config['SECRET_KEY'] = 'test'
+        self.app.test_client_class = FlaskLoginClient
+        users = [User(username=f'u{i}', email=f'u{i}@example.com')
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.add_all([Message(author=users[i % 5], recipient=users[0],
+                                    body=f'hello {i}') for i in range(20)])
+        db.session.add_all([Companion(creator=users[i % 2],
+                                      companion_name=f'c{i}')
+                            for i in range(10)])
+        db.session.commit()
+        client = self.app.test_client(user=users[0])
+        for path, budget in VIEW_QUERY_BUDGETS:
+            db.session.expunge_all()
+            with count_queries(db.engine) as statements:
+                self.assertEqual(client.get(path).status_code, 200, path)
+            self.assertLessEqual(len(statements), budget, path)
+
+    def test_api_user_companions(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u] + [Companion(creator=u, companion_name=str(i))
+                                  for i in range(3)])
+        token = u.get_token()
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + token}
+        client = self.app.test_client()
+        user = client.get(f'/api/users/{u.id}', headers=headers).get_json()
+        self.assertEqual(user['companion_count'], 3)
+        companions = client.get(user['_links']['companions'] + '?per_page=2',
+                                headers=headers).get_json()
+        self.assertEqual([c['companion_name'] for c in companions['items']],
+                         ['0', '1'])
+        self.assertEqual(companions['_meta']['total_items'], 3)
+        self.assertIsNotNone(companions['_links']['next'])
+
+    def test_seed(self):
+        result_cache.local.clear()
+        existing = User(username='john', email='john@example.com')
+        db.session.add(existing)
+        db.session.commit()
+        seeder = Seeder(chunk_size=7, password='dog', seed=1)
+        rows = seeder.run(10, messages=4, companions=3,
+                          message_distribution='fixed',
+                          companion_distribution='uniform')
+        self.assertEqual(rows['user'], 10)
+        self.assertEqual(rows['message'], 40)
+        self.assertEqual(rows['notification'], 10)
+        self.assertEqual(rows['search'], 40)
+        self.assertEqual(rows['companion'], db.session.scalar(
+            sa.select(sa.func.count(Companion.id))))
+        # the counters were filled in without the flush hooks
+        self.assertEqual(reconcile_counters(), 0)
+        user = db.session.scalar(sa.select(User).where(
+            User.username == 'seed2'))
+        self.assertTrue(user.check_password('dog'))
+        self.assertEqual(user.unread_message_count, 4)
+        word = db.session.scalar(sa.select(Message.body)).split()[0]
+        self.assertGreater(Message.search(word, 1, 10)[1], 0)
+
+        rows = Seeder(seed=1).run(2, messages=1, index=False)
+        self.assertNotIn('search', rows)
+
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = messages
+        self.closed = False
+
+    def subscribe(self, *channels):
+        pass
+
+    def get_message(self, timeout=None):
+        return self.messages.pop(0) if self.messages else None
+
+    def close(self):
+        self.closed = True
+
+
+class NotificationStreamCase(unittest.TestCase):
+    def test_backlog_then_published_events(self):
+        backlog = [{'name': 'a', 'data': 1, 'timestamp': 10.0}]
+        pubsub = FakePubSub([
+            {'type': 'message', 'data': json.dumps(
+                {'name': 'a', 'data': 1, 'timestamp': 10.0})},
+            {'type': 'message', 'data': json.dumps(
+                {'name': 'b', 'data': 2, 'timestamp': 11.0})},
+        ])
+        events = list(notification_events(pubsub, backlog, 5.0, timeout=0.5))
+        self.assertEqual(events[0], 'retry: 2000\n\n')
+        self.assertEqual(len(events), 3)
+        self.assertTrue(events[1].startswith('id: 10.0\n'))
+        self.assertTrue(events[2].startswith('id: 11.0\n'))
+        self.assertTrue(pubsub.closed)
+
+class QueryPlanConfig(TestConfig):
+    # set QUERY_PLAN_DATABASE_URL to a scratch MySQL database to check its
+    # plans too; every table in it is dropped afterwards
+    SQLALCHEMY_DATABASE_URI = os.environ.get('QUERY_PLAN_DATABASE_URL') or \
+        'sqlite://'
+    SECRET_KEY = 'test'
+
+# the views and model calls behind every page; none of their statements may
+# read a whole table
+HOT_PATHS = ['/index', '/messages', '/notifications?since=1', '/tasks',
+             '/user/seed2', '/user/seed2/popup', '/export_companions']
+
+
+def full_scans(connection, statement, parameters):
+    """Tables that EXPLAIN says statement reads in full, index scans
+    included."""
+    tables = db.metadata.tables
+    if connection.dialect.name == 'sqlite':
+        plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement,
+                                          parameters)
+        return [row.detail for row in plan
+                if re.match(r'SCAN (\w+)', row.detail)
+                and re.match(r'SCAN (\w+)', row.detail).group(1) in tables]
+    plan = connection.exec_driver_sql('EXPLAIN ' + statement, parameters)
+    return ['{0} ({1})'.format(row.table, row.type) for row in plan
+            if row.type in ('ALL', 'index') and row.table in tables]
+
+
+class QueryPlanCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(QueryPlanConfig)
+        self.app.test_client_class = FlaskLoginClient
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Seeder(seed=1).run(200, messages=20, companions=3, index=False)
+        db.session.add_all([Task(id=f'task-{i}', name='export_companions',
+                                 user_id=i % 200 + 1, complete=i % 3 == 0)
+                            for i in range(600)])
+        db.session.commit()
+        with db.engine.begin() as conn:
+            if conn.dialect.name == 'sqlite':
+                conn.exec_driver_sql('ANALYZE')
+            else:
+                conn.exec_driver_sql('ANALYZE TABLE ' + ', '.join(
+                    db.metadata.tables))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_hot_queries_use_indexes(self):
+        user = db.session.scalar(sa.select(User).where(
+            User.username == 'seed1'))
+        client = self.app.test_client(user=user)
+        with count_queries(db.engine, parameters=True) as statements:
+            for path in HOT_PATHS:
+                self.assertLess(client.get(path).status_code, 400, path)
+            user.add_notification('unread_message_count', 0)
+            user.get_task_in_progress('export_companions')
+            db.session.commit()
+            Notification.prune(time.time() - 86400)
+        with db.engine.connect() as conn:
+            for statement, parameters in statements:
+                if statement.split()[0].upper() not in \
+                        ('SELECT', 'UPDATE', 'DELETE'):
+                    continue
+                self.assertEqual(
+                    full_scans(conn, statement, parameters), [],
+                    ' '.join(statement.split()))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -0,0 +1,122 @@
+import hashlib
+from flask import current_app
+from app.cache import Cache
+
+# (provider, source, dest, text hash) -> translation, so switching providers
+# doesn't keep serving the old one's output. Redis bounds it with the TTL
+# (and its maxmemory LRU policy); the in-process fallback is an LRU
+translation_cache = Cache('translation:', maxsize=4096)
+
+
+class TranslationError(Exception):
+    pass
+
+
+class LocalTranslator:
+    """Stand-in that tags the text with the language pair instead of
+    translating it. Deterministic and offline, for development and tests;
+    calls counts the requests that reached it."""
+
+    max_batch = 100
+    max_chars = 50000
+
+    def __init__(self):
+        self.calls = 0
+
+    def translate_many(self, texts, source, dest):
+        self.calls += 1
+        return [f'[{source}>{dest}] {text}' for text in texts]
+
+
+class MicrosoftTranslator:
+    """Azure AI Translator, up to max_batch texts and max_chars characters
+    per request; past either limit the service answers 400."""
+
+    url = 'https://api.cognitive.microsofttranslator.com/translate'
+    max_batch = 100
+    max_chars = 50000
+
+    def __init__(self, key, region=None, timeout=10):
+        import requests
+        self.requests = requests
+        self.headers = {'Ocp-Apim-Subscription-Key': key}
+        if region:
+            self.headers['Ocp-Apim-Subscription-Region'] = region
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def translate_many(self, texts, source, dest):
+        try:
+            response = self.session.post(
+                self.url, headers=self.headers, timeout=self.timeout,
+                params={'api-version': '3.0', 'from': source, 'to': dest},
+                json=[{'Text': text} for text in texts])
+        except self.requests.RequestException as e:
+            raise TranslationError(str(e)) from e
+        if response.status_code != 200:
+            raise TranslationError(
+                f'translation service returned {response.status_code}')
+        return [item['translations'][0]['text'] for item in response.json()]
+
+
+def create_translator(app):
+    provider = app.config['TRANSLATION_PROVIDER']
+    if provider == 'microsoft':
+        return MicrosoftTranslator(app.config['MS_TRANSLATOR_KEY'],
+                                   app.config['MS_TRANSLATOR_REGION'])
+    if provider == 'local':
+        return LocalTranslator()
+    return None
+
+
+def _cache_key(text, source, dest):
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    provider = current_app.config['TRANSLATION_PROVIDER']
+    return f'{provider}:{source}:{dest}:{digest}'
+
+
+def _batches(pending, max_batch, max_chars):
+    # (key, text) pairs grouped into requests of at most max_batch texts and
+    # max_chars characters; a longer text goes alone
+    batch, chars = [], 0
+    for key, text in pending:
+        if batch and (len(batch) == max_batch or
+                      chars + len(text) > max_chars):
+            yield batch
+            batch, chars = [], 0
+        batch.append((key, text))
+        chars += len(text)
+    if batch:
+        yield batch
+
+
+def translate_many(texts, source, dest):
+    """Translate texts from source to dest, in order. Cached translations are
+    fetched in one round trip and each distinct text that is left goes to
+    the provider once, in as few requests as its batch limits allow."""
+    translator = current_app.translator
+    if translator is None:
+        raise TranslationError('no translation provider is configured')
+    keys = [_cache_key(text, source, dest) for text in texts]
+    cached = dict(zip(keys, translation_cache.get_many(*keys)))
+    missing = {}
+    for key, text in zip(keys, texts):
+        if cached[key] is None:
+            missing.setdefault(key, text)
+        translation_cache.record(cached[key] is not None)
+    if missing:
+        translated = {}
+        for batch in _batches(missing.items(), translator.max_batch,
+                              translator.max_chars):
+            translated.update(zip(
+                (key for key, _ in batch),
+                translator.translate_many([text for _, text in batch],
+                                          source, dest)))
+        translation_cache.set_many(translated,
+                                   current_app.config['TRANSLATION_CACHE_TTL'])
+        cached.update(translated)
+    return [cached[key] for key in keys]
+
+
+def translate(text, source, dest):
+    return translate_many([text], source, dest)[0]
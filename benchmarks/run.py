@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""Load benchmark for the hot routes.
+
+Boots the application in process against SQLite (or the empty scratch
+database given with --database-url), fakeredis when it is installed (or the
+Redis given with --redis-url), the embedded SQLite search index and an
+aiosmtpd sink, seeds it, then drives each route from --concurrency threads
+and prints one JSON document with throughput, p50/p95/p99 latency and
+queries per request, so runs can be compared between commits:
+
+    python -m benchmarks.run --requests 500 --output before.json
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# config.py reads these at import time
+os.environ.setdefault('MAIL_PORT', '25')
+os.environ.setdefault('ADMINS', 'admin@example.com')
+
+import redis
+import rq
+import sqlalchemy as sa
+from flask_login import FlaskLoginClient
+from app import create_app, db
+from app.models import User, Companion, Message
+from config import Config
+
+PASSWORD = 'benchmark'
+SEARCH_TERMS = ['weather', 'music', 'garden', 'travel', 'coffee']
+
+ROUTES = {
+    'index': lambda i, user, other, token: ('GET', '/index', {}),
+    'messages': lambda i, user, other, token: ('GET', '/messages', {}),
+    'notifications': lambda i, user, other, token: ('GET', '/notifications', {}),
+    'user_popup': lambda i, user, other, token: (
+        'GET', f'/user/{other}/popup', {}),
+    'search': lambda i, user, other, token: (
+        'GET', '/search?q=' + SEARCH_TERMS[i % len(SEARCH_TERMS)],
+        {}),
+    'api_users': lambda i, user, other, token: (
+        'GET', '/api/users', {'Authorization': f'Bearer {token}'}),
+    'api_tokens': lambda i, user, other, token: (
+        'POST', '/api/tokens', {'Authorization': 'Basic ' + base64.b64encode(
+            f'{user}:{PASSWORD}'.encode('utf-8')).decode('utf-8')}),
+}
+
+
+class QueryCounter:
+    """Counts the statements each thread sends to any engine."""
+
+    def __init__(self):
+        self.local = threading.local()
+        sa.event.listen(sa.engine.Engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def take(self):
+        count = getattr(self.local, 'count', 0)
+        self.local.count = 0
+        return count
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_mail_sink():
+    from aiosmtpd.controller import Controller
+
+    class Sink:
+        received = 0
+
+        async def handle_DATA(self, server, session, envelope):
+            self.received += 1
+            return '250 OK'
+
+    sink = Sink()
+    controller = Controller(sink, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    return controller, sink
+
+
+def make_config(args, workdir, mail_port):
+    class BenchConfig(Config):
+        SECRET_KEY = 'benchmark'
+        SQLALCHEMY_DATABASE_URI = args.database_url or \
+            'sqlite:///' + os.path.join(workdir, 'bench.db')
+        SEARCH_SQLITE_PATH = ':memory:'
+        ELASTICSEARCH_URL = None
+        MAIL_SERVER = '127.0.0.1'
+        MAIL_PORT = mail_port
+        MAIL_USE_TLS = False
+        MAIL_USERNAME = MAIL_PASSWORD = None
+        REDIS_URL = args.redis_url or Config.REDIS_URL
+        SLOW_REQUEST_THRESHOLD = 0
+        SLOW_QUERY_THRESHOLD = 0
+    if BenchConfig.SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        BenchConfig.SQLALCHEMY_ENGINE_OPTIONS = {
+            'connect_args': {'check_same_thread': False, 'timeout': 30}}
+    return BenchConfig
+
+
+def use_fakeredis(app):
+    """Swap in fakeredis unless a real Redis was asked for. Returns a label
+    for the report."""
+    try:
+        import fakeredis
+    except ImportError:
+        try:
+            app.redis.ping()
+        except redis.exceptions.RedisError:
+            # the app falls back to in-process caches and locks
+            return 'unavailable'
+        return app.config['REDIS_URL']
+    app.redis = fakeredis.FakeRedis()
+    app.task_queue = rq.Queue('ai_companion-tasks', connection=app.redis)
+    app.mail_queue = rq.Queue('ai_companion-mail', connection=app.redis)
+    return 'fakeredis'
+
+
+def seed(args):
+    users = [User(username=f'bench{i}', email=f'bench{i}@example.com',
+                  about_me=f'Benchmark user {i}')
+             for i in range(args.users)]
+    users[0].set_password(PASSWORD)
+    for user in users[1:]:
+        # hashing is deliberately slow, every user can share one hash
+        user.password_hash = users[0].password_hash
+    db.session.add_all(users)
+    db.session.flush()
+    for i, user in enumerate(users):
+        db.session.add_all([
+            Companion(creator=user, companion_name=f'companion{i}-{j}',
+                      gender='female' if j % 2 else 'male', realism=j % 10)
+            for j in range(args.companions)])
+        db.session.add_all([
+            Message(author=users[(i + j + 1) % len(users)], recipient=user,
+                    body='Talking about {0} and {1}'.format(
+                        SEARCH_TERMS[j % len(SEARCH_TERMS)],
+                        SEARCH_TERMS[(i + j) % len(SEARCH_TERMS)]))
+            for j in range(args.messages)])
+        db.session.flush()
+    db.session.commit()
+    return [user.username for user in users]
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * len(samples))))]
+
+
+def run_route(app, route, users, tokens, args, counter):
+    clients = {}
+
+    def client_for(username):
+        # one client per thread, logged in as a user of its own
+        key = threading.get_ident()
+        if key not in clients:
+            client = app.test_client()
+            with app.app_context():
+                user = db.session.scalar(sa.select(User).where(
+                    User.username == username))
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user.id)
+                    session['_fresh'] = True
+            clients[key] = client
+        return clients[key]
+
+    def one(i):
+        username = users[i % len(users)]
+        other = users[(i + 1) % len(users)]
+        method, path, headers = ROUTES[route](i, username, other,
+                                              tokens[username])
+        client = client_for(username)
+        counter.take()
+        started = time.perf_counter()
+        response = client.open(path, method=method, headers=headers)
+        elapsed = time.perf_counter() - started
+        return elapsed, counter.take(), response.status_code
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(one, range(args.warmup)))
+        started = time.perf_counter()
+        results = list(executor.map(one, range(args.requests)))
+        wall = time.perf_counter() - started
+    latencies = [elapsed * 1000 for elapsed, _, _ in results]
+    errors = sum(1 for _, _, status in results if status >= 400)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'throughput_rps': round(len(results) / wall, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'queries_per_request': round(
+            sum(queries for _, queries, _ in results) / len(results), 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], text=True,
+            stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url',
+                        help='defaults to a temporary SQLite file; must '
+                             'be an empty database unless --drop is given')
+    parser.add_argument('--drop', action='store_true',
+                        help='drop every table in --database-url before and '
+                             'after the run')
+    parser.add_argument('--redis-url',
+                        help='use this Redis instead of fakeredis')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='unmeasured requests per route')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=40,
+                        help='messages received per user')
+    parser.add_argument('--companions', type=int, default=5,
+                        help='companions per user')
+    parser.add_argument('--routes', default=','.join(ROUTES),
+                        help='comma separated subset of ' + ', '.join(ROUTES))
+    parser.add_argument('--output', help='write the JSON here too')
+    args = parser.parse_args(argv)
+    routes = [route for route in args.routes.split(',') if route]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error('unknown routes: ' + ', '.join(sorted(unknown)))
+
+    if args.database_url and not args.drop:
+        engine = sa.create_engine(args.database_url)
+        tables = sa.inspect(engine).get_table_names()
+        engine.dispose()
+        if tables:
+            parser.error('--database-url has tables ({0}); point it at an '
+                         'empty database or pass --drop to wipe it'.format(
+                             ', '.join(sorted(tables))))
+
+    controller, sink = start_mail_sink()
+    with tempfile.TemporaryDirectory() as workdir:
+        app = create_app(make_config(args, workdir, controller.port))
+        app.test_client_class = FlaskLoginClient
+        redis_label = args.redis_url or use_fakeredis(app)
+        counter = QueryCounter()
+        with app.app_context():
+            if args.drop:
+                db.drop_all()
+            db.create_all()
+            users = seed(args)
+            tokens = {}
+            for username in users:
+                user = db.session.scalar(sa.select(User).where(
+                    User.username == username))
+                tokens[username] = user.get_token()
+            db.session.commit()
+        report = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'database': sa.engine.make_url(
+                app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name(),
+            'redis': redis_label,
+            'search': type(app.search_backend).__name__,
+            'concurrency': args.concurrency,
+            'seed': {'users': args.users, 'messages': args.messages,
+                     'companions': args.companions},
+            'routes': {},
+        }
+        try:
+            for route in routes:
+                report['routes'][route] = run_route(app, route, users,
+                                                    tokens, args, counter)
+            app.mail_pool.join(timeout=10)
+            report['mail_received'] = sink.received
+        finally:
+            controller.stop()
+            with app.app_context():
+                if args.database_url:
+                    # only the tables this run created, in an empty database
+                    # or one --drop was given for
+                    db.drop_all()
+                db.engine.dispose()
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,13 @@
 #!/bin/bash
 
 # this script is used to boot a Docker container
+
+# `boot.sh worker` runs the RQ worker for the task and mail queues instead of
+# the web server; the web container applies the migrations
+if [[ "$1" == "worker" ]]; then
+    exec flask worker
+fi
+
 # kill db connection attempts after 1min, just in case
 MAX_ATTEMPTS=12
 attempt=1
@@ -20,4 +27,15 @@ while [ $attempt -le $MAX_ATTEMPTS ]; do
     fi
     sleep 5
 done
-exec gunicorn -b :5000 --access-logfile - --error-logfile - ai_companion:app
\ No newline at end of file
+# each gunicorn worker writes its metrics here and /metrics merges them; files
+# left over from a previous run would be counted again
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+# each open notification stream holds a thread until it times out; at most
+# half of every worker's threads go to streams, past that tabs poll instead.
+# Raise GUNICORN_THREADS (or the worker count) with the number of open tabs
+# expected per worker
+GUNICORN_THREADS=${GUNICORN_THREADS:-8}
+export NOTIFICATION_STREAM_MAX=${NOTIFICATION_STREAM_MAX:-$((GUNICORN_THREADS / 2))}
+exec gunicorn -b :5000 --worker-class gthread --threads $GUNICORN_THREADS --access-logfile - --error-logfile - ai_companion:app
\ No newline at end of file
@@ -9,10 +9,54 @@ class Config:
 	SECRET_KEY = os.environ.get('SECRET_KEY')
 	SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
 		'sqlite:///' + os.path.join(basedir, 'app.db')
+	# each process has its own pool. A gunicorn worker runs GUNICORN_THREADS
+	# request threads, so by default every thread gets a connection plus a
+	# few overflow ones for the flusher and mail threads; the database needs
+	# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections. Connections are
+	# pinged before use and recycled before MySQL's wait_timeout drops them
+	DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or
+		os.environ.get('GUNICORN_THREADS') or 8)
+	DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 4)
+	DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT') or 10)
+	DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE') or 1800)
+	DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') != '0'
+	SQLALCHEMY_ENGINE_OPTIONS = {
+		'pool_size': DB_POOL_SIZE,
+		'max_overflow': DB_MAX_OVERFLOW,
+		'pool_timeout': DB_POOL_TIMEOUT,
+		'pool_recycle': DB_POOL_RECYCLE,
+		'pool_pre_ping': DB_POOL_PRE_PING,
+	}
+	# comma separated read replica URLs. Views marked @read_replica, and all
+	# GET requests if REPLICA_ROUTE_GETS is set, read from them; a client that
+	# committed reads from the primary for REPLICA_STICKY_SECONDS afterwards
+	SQLALCHEMY_REPLICA_URIS = [url for url in (
+		os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if url]
+	REPLICA_ROUTE_GETS = os.environ.get('REPLICA_ROUTE_GETS') is not None
+	REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS') or 10)
+	REPLICA_CHECK_INTERVAL = int(os.environ.get('REPLICA_CHECK_INTERVAL') or 5)
+	REPLICA_RETRY_INTERVAL = int(os.environ.get('REPLICA_RETRY_INTERVAL') or 30)
 	
 	REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
 
 	ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+	# without Elasticsearch, search uses an embedded SQLite FTS5 index stored
+	# here; set it to an empty string to turn search off
+	SEARCH_SQLITE_PATH = os.environ.get('SEARCH_SQLITE_PATH',
+		os.path.join(basedir, 'search.db'))
+	# search results are cached per index generation for SEARCH_CACHE_TTL
+	# seconds; the last result for a query is kept for SEARCH_STALE_TTL
+	# seconds to answer while the search backend is down
+	SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 300)
+	SEARCH_STALE_TTL = int(os.environ.get('SEARCH_STALE_TTL') or 86400)
+	# index changes are queued in the search_outbox table and shipped by the
+	# RQ worker in bulk requests of this size; failed documents are retried
+	# with exponential backoff capped at SEARCH_OUTBOX_MAX_BACKOFF seconds,
+	# and parked after SEARCH_OUTBOX_MAX_ATTEMPTS failures. Retries are
+	# scheduled with enqueue_in, which `flask worker` schedules
+	SEARCH_OUTBOX_BATCH_SIZE = int(os.environ.get('SEARCH_OUTBOX_BATCH_SIZE') or 500)
+	SEARCH_OUTBOX_MAX_BACKOFF = int(os.environ.get('SEARCH_OUTBOX_MAX_BACKOFF') or 300)
+	SEARCH_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('SEARCH_OUTBOX_MAX_ATTEMPTS') or 10)
 
 	MAIL_SERVER = os.environ.get('MAIL_SERVER')
 	MAIL_PORT = int(os.environ.get('MAIL_PORT'))
@@ -20,7 +64,113 @@ class Config:
 	MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
 	MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
 	ADMINS = os.environ.get('ADMINS').split(',')
+	# 'pool' sends from MAIL_POOL_SIZE threads in this process, each reusing
+	# its SMTP connection until it has been idle for MAIL_POOL_IDLE seconds;
+	# 'rq' hands messages to the worker listening on the mail queue (`flask
+	# worker`, or `boot.sh worker` in the container). Either way a failed
+	# message is retried MAIL_MAX_RETRIES times
+	MAIL_DELIVERY = os.environ.get('MAIL_DELIVERY') or 'pool'
+	MAIL_POOL_SIZE = int(os.environ.get('MAIL_POOL_SIZE') or 2)
+	MAIL_POOL_IDLE = float(os.environ.get('MAIL_POOL_IDLE') or 5)
+	MAIL_QUEUE_MAX = int(os.environ.get('MAIL_QUEUE_MAX') or 1000)
+	MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES') or 3)
 
 	LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+	# make lazy loads outside a view's loader profile raise (for development
+	# and tests) instead of issuing one query per row
+	RAISE_ON_LAZY_LOAD = os.environ.get('RAISE_ON_LAZY_LOAD') is not None
+	# requests and SQL statements slower than these many seconds are logged
+	# with their query, Redis and Elasticsearch counts; 0 turns logging off
+	SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD') or 1)
+	SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD') or 0.25)
+	# /metrics answers scrapes from METRICS_ALLOWED_IPS (comma separated
+	# addresses or networks) or with an "Authorization: Bearer METRICS_TOKEN"
+	# header. Gauges that need a query are refreshed every
+	# METRICS_DB_INTERVAL seconds at most
+	METRICS_ALLOWED_IPS = [ip for ip in (
+		os.environ.get('METRICS_ALLOWED_IPS') or '127.0.0.1,::1').split(',') if ip]
+	METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+	METRICS_DB_INTERVAL = int(os.environ.get('METRICS_DB_INTERVAL') or 15)
 	ITEMS_PER_PAGE = 20
+	# collection totals are cached and only recounted after this many seconds
+	PAGINATION_COUNT_TTL = int(os.environ.get('PAGINATION_COUNT_TTL') or 60)
+
+	# last_seen is buffered and written out in bulk, so it may lag by up to
+	# PRESENCE_FLUSH_INTERVAL seconds, and is only refreshed once it is older
+	# than PRESENCE_STALENESS seconds. Set the interval to 0 to disable the
+	# background flusher (e.g. when running `flask presence flush` from cron).
+	PRESENCE_FLUSH_INTERVAL = int(os.environ.get('PRESENCE_FLUSH_INTERVAL') or 30)
+	PRESENCE_STALENESS = int(os.environ.get('PRESENCE_STALENESS') or 60)
+
+	# API token lookups are cached for at most this many seconds (and never
+	# past the token's expiration)
+	TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 300)
+	# users loaded by id (every request) or username (profiles, popups)
+	USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 300)
+
+	# /notifications/stream connections are closed after this many seconds and
+	# the browser reconnects, resuming from the last event id it received
+	NOTIFICATION_STREAM_TIMEOUT = int(
+		os.environ.get('NOTIFICATION_STREAM_TIMEOUT') or 300)
+	# every open stream holds a gunicorn thread, so each process serves at
+	# most NOTIFICATION_STREAM_MAX of them and further tabs poll instead.
+	# Keep it below the thread count (boot.sh sets it to half)
+	NOTIFICATION_STREAM_MAX = int(os.environ.get('NOTIFICATION_STREAM_MAX') or 4)
+	# notifications not updated for NOTIFICATION_RETENTION_DAYS are deleted by
+	# the compaction job, NOTIFICATION_PRUNE_CHUNK rows per transaction with a
+	# NOTIFICATION_PRUNE_PAUSE second pause in between. The job also marks
+	# tasks whose job ended without its callback complete, and reschedules
+	# itself every NOTIFICATION_PRUNE_INTERVAL seconds (0 runs it once); it
+	# uses enqueue_in, which `flask worker` schedules
+	NOTIFICATION_RETENTION_DAYS = float(
+		os.environ.get('NOTIFICATION_RETENTION_DAYS') or 30)
+	NOTIFICATION_PRUNE_CHUNK = int(os.environ.get('NOTIFICATION_PRUNE_CHUNK') or 1000)
+	NOTIFICATION_PRUNE_PAUSE = float(os.environ.get('NOTIFICATION_PRUNE_PAUSE') or 0.1)
+	NOTIFICATION_PRUNE_INTERVAL = int(
+		os.environ.get('NOTIFICATION_PRUNE_INTERVAL') or 86400)
+
+	# data exports are streamed to files under EXPORT_DIR (gzipped when
+	# EXPORT_COMPRESS is set). Files up to EXPORT_ATTACHMENT_MAX bytes are
+	# emailed as attachments, bigger ones as a link relative to APP_URL. Rows
+	# are read EXPORT_BATCH_SIZE at a time. Each user keeps only their latest
+	# export, and the prune job deletes exports older than
+	# EXPORT_RETENTION_DAYS
+	EXPORT_DIR = os.environ.get('EXPORT_DIR') or os.path.join(basedir, 'exports')
+	EXPORT_COMPRESS = os.environ.get('EXPORT_COMPRESS') is not None
+	EXPORT_ATTACHMENT_MAX = int(os.environ.get('EXPORT_ATTACHMENT_MAX') or 1048576)
+	EXPORT_MAX_RUNTIME = int(os.environ.get('EXPORT_MAX_RUNTIME') or 600)
+	EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 500)
+	EXPORT_RETENTION_DAYS = float(os.environ.get('EXPORT_RETENTION_DAYS') or 7)
+	APP_URL = os.environ.get('APP_URL') or 'http://localhost:5000'
+	# task progress is reported at most TASK_PROGRESS_RATE times per second,
+	# or whenever it has moved TASK_PROGRESS_STEP percent
+	TASK_PROGRESS_RATE = float(os.environ.get('TASK_PROGRESS_RATE') or 1)
+	TASK_PROGRESS_STEP = int(os.environ.get('TASK_PROGRESS_STEP') or 5)
+	# message languages are detected by an RQ job, LANGDETECT_BATCH_SIZE
+	# messages per UPDATE; the seed makes detection repeatable
+	LANGDETECT_BATCH_SIZE = int(os.environ.get('LANGDETECT_BATCH_SIZE') or 500)
+	LANGDETECT_SEED = int(os.environ.get('LANGDETECT_SEED') or 0)
+	# messages are translated by TRANSLATION_PROVIDER: 'microsoft' (Azure AI
+	# Translator, the default when MS_TRANSLATOR_KEY is set) or 'local', an
+	# offline stand-in that only tags the text. Unset turns translation off.
+	# Translations are cached for TRANSLATION_CACHE_TTL seconds and a batch
+	# request takes at most TRANSLATION_BATCH_MAX message ids
+	MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+	MS_TRANSLATOR_REGION = os.environ.get('MS_TRANSLATOR_REGION')
+	TRANSLATION_PROVIDER = os.environ.get('TRANSLATION_PROVIDER') or \
+		('microsoft' if MS_TRANSLATOR_KEY else None)
+	TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 30 * 86400)
+	TRANSLATION_BATCH_MAX = int(os.environ.get('TRANSLATION_BATCH_MAX') or 100)
+	# avatars are Gravatar identicons unless AVATAR_PROVIDER is 'local', which
+	# draws them here at /avatar/<digest>/<size>, in the AVATAR_SIZES the
+	# templates use. Images of users' digests are kept under AVATAR_CACHE_DIR
+	# when it is set and in Redis for AVATAR_CACHE_TTL seconds otherwise;
+	# browsers may keep them for AVATAR_MAX_AGE seconds, as a new email means
+	# a new URL
+	AVATAR_PROVIDER = os.environ.get('AVATAR_PROVIDER') or 'gravatar'
+	AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR')
+	AVATAR_CACHE_TTL = int(os.environ.get('AVATAR_CACHE_TTL') or 7 * 86400)
+	AVATAR_SIZES = [int(size) for size in (
+		os.environ.get('AVATAR_SIZES') or '64,70,128,256').split(',')]
+	AVATAR_MAX_AGE = int(os.environ.get('AVATAR_MAX_AGE') or 365 * 86400)
 	LANGUAGES = ['en', 'es']
\ No newline at end of file
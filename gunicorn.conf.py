@@ -0,0 +1,9 @@
+# gunicorn reads this file from the working directory on startup
+import os
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    # drop the live gauges of a worker that exited; its histograms stay
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,49 @@
+"""composite indexes
+
+Revision ID: 2214a086d89b
+Revises: f21d87ade529
+Create Date: 2026-10-18 05:00:13.670185
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2214a086d89b'
+down_revision = 'f21d87ade529'
+branch_labels = None
+depends_on = None
+
+
+# the composite indexes lead with the foreign key column, so they replace the
+# single column ones; MySQL needs an index on the foreign key at all times, so
+# each replacement is created before the index it replaces is dropped
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_recipient_id_timestamp', ['recipient_id', 'timestamp'], unique=False)
+        batch_op.drop_index('ix_message_recipient_id')
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_index('ix_notification_user_id_name', ['user_id', 'name'], unique=False)
+        batch_op.create_index('ix_notification_user_id_timestamp', ['user_id', 'timestamp'], unique=False)
+        batch_op.drop_index('ix_notification_user_id')
+
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.create_index('ix_task_user_id_name_complete', ['user_id', 'name', 'complete'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.drop_index('ix_task_user_id_name_complete')
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_index('ix_notification_user_id', ['user_id'], unique=False)
+        batch_op.drop_index('ix_notification_user_id_timestamp')
+        batch_op.drop_index('ix_notification_user_id_name')
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_recipient_id', ['recipient_id'], unique=False)
+        batch_op.drop_index('ix_message_recipient_id_timestamp')
@@ -0,0 +1,49 @@
+"""user counters
+
+Revision ID: 59007ae04298
+Revises: d4b7d9892786
+Create Date: 2026-10-18 09:12:41.508316
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '59007ae04298'
+down_revision = 'd4b7d9892786'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('companion_count', sa.Integer(),
+                                      server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('unread_message_count', sa.Integer(),
+                                      server_default='0', nullable=False))
+
+    user = sa.table('user', sa.column('id', sa.Integer),
+                    sa.column('last_message_read_time', sa.DateTime),
+                    sa.column('companion_count', sa.Integer),
+                    sa.column('unread_message_count', sa.Integer))
+    companion = sa.table('companion', sa.column('id', sa.Integer),
+                         sa.column('associated_user_id', sa.Integer))
+    message = sa.table('message', sa.column('id', sa.Integer),
+                       sa.column('recipient_id', sa.Integer),
+                       sa.column('timestamp', sa.DateTime))
+    op.execute(user.update().values(
+        companion_count=sa.select(sa.func.count(companion.c.id)).where(
+            companion.c.associated_user_id == user.c.id).scalar_subquery(),
+        unread_message_count=sa.select(sa.func.count(message.c.id)).where(
+            message.c.recipient_id == user.c.id,
+            message.c.timestamp > sa.func.coalesce(
+                user.c.last_message_read_time, datetime(1900, 1, 1))
+        ).scalar_subquery()))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('unread_message_count')
+        batch_op.drop_column('companion_count')
@@ -0,0 +1,47 @@
+"""avatar digest
+
+Revision ID: 6d1df20f4ba5
+Revises: d9af948fb2e8
+Create Date: 2026-10-18 05:11:50.782645
+
+"""
+import hashlib
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6d1df20f4ba5'
+down_revision = 'd9af948fb2e8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('avatar_digest', sa.String(length=32), nullable=True))
+
+    # md5() is not portable SQL, so the digests are computed here, in id
+    # order 1000 users at a time
+    user = sa.table('user', sa.column('id', sa.Integer),
+                    sa.column('email', sa.String),
+                    sa.column('avatar_digest', sa.String))
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(sa.select(user.c.id, user.c.email).where(
+            user.c.id > last_id).order_by(user.c.id).limit(1000)).all()
+        if not rows:
+            break
+        conn.execute(
+            user.update().where(user.c.id == sa.bindparam('user_id')).values(
+                avatar_digest=sa.bindparam('digest')),
+            [{'user_id': row.id, 'digest': hashlib.md5(
+                row.email.strip().lower().encode('utf-8')).hexdigest()}
+             for row in rows])
+        last_id = rows[-1].id
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('avatar_digest')
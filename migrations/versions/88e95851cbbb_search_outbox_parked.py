@@ -0,0 +1,26 @@
+"""search outbox parked
+
+Revision ID: 88e95851cbbb
+Revises: fc2cdb4ac78a
+Create Date: 2026-10-18 05:37:22.277363
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '88e95851cbbb'
+down_revision = 'fc2cdb4ac78a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('search_outbox', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('parked', sa.Boolean(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('search_outbox', schema=None) as batch_op:
+        batch_op.drop_column('parked')
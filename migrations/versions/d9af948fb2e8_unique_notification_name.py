@@ -0,0 +1,33 @@
+"""unique notification name
+
+Revision ID: d9af948fb2e8
+Revises: 2214a086d89b
+Create Date: 2026-10-18 05:01:39.722681
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd9af948fb2e8'
+down_revision = '2214a086d89b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # older code could leave several rows per user and name; keep the newest.
+    # MySQL cannot read the table it deletes from, hence the derived table
+    op.execute('DELETE FROM notification WHERE id NOT IN (SELECT id FROM ('
+               'SELECT max(id) AS id FROM notification GROUP BY user_id, name'
+               ') AS newest)')
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_index('ix_notification_user_id_name')
+        batch_op.create_index('ix_notification_user_id_name', ['user_id', 'name'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_index('ix_notification_user_id_name')
+        batch_op.create_index('ix_notification_user_id_name', ['user_id', 'name'], unique=False)
@@ -0,0 +1,26 @@
+"""avatar digest index
+
+Revision ID: fc2cdb4ac78a
+Revises: 6d1df20f4ba5
+Create Date: 2026-10-18 05:26:37.651005
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fc2cdb4ac78a'
+down_revision = '6d1df20f4ba5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_user_avatar_digest'), ['avatar_digest'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_avatar_digest'))